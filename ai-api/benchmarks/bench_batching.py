@@ -0,0 +1,41 @@
+"""Total time and per-image latency of queued txt2img tasks for several batch size caps."""
+import io
+import time
+import argparse
+import contextlib
+from datetime import datetime
+
+from common import server
+from stub_webui import StubWebUI
+
+def run(stub, batch_size, task_count):
+    server.SD_MAX_BATCH_SIZE = batch_size
+    calls_before = len(stub.calls)
+    # Queue every task before the worker starts, as a backlog of identical single-image requests
+    task_ids = [server.queue_task({"prompt": "room", "n_iter": 1}, "txt2img", f"client-{i}")["task_id"] for i in range(task_count)]
+    with contextlib.redirect_stdout(io.StringIO()):  # Hide the per-task log lines
+        start = time.perf_counter()
+        backend = server.start_task_worker(stub.url)
+        while any(server.get_task_queue_status(task_id)["status"] in ("pending", "running") for task_id in task_ids):
+            time.sleep(0.005)
+        total_seconds = time.perf_counter() - start
+        server.stop_task_worker(backend)
+
+    tasks = [server.get_task_queue_status(task_id) for task_id in task_ids]
+    assert all(task["status"] == "success" for task in tasks)
+    latencies = [(datetime.fromisoformat(task["finished_at"]) - datetime.fromisoformat(task["queued_at"])).total_seconds() for task in tasks]
+    print(f"batch {batch_size:>2}   {len(stub.calls) - calls_before:>3} calls   total {total_seconds:6.2f} s   "
+          f"mean latency {sum(latencies) / len(latencies):6.2f} s   {total_seconds / task_count * 1000:6.0f} ms/image")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tasks", type=int, default=16)
+    parser.add_argument("--overhead", type=float, default=0.3, help="Seconds every stub WebUI call takes")
+    parser.add_argument("--per-image", type=float, default=0.1, help="Extra stub seconds per generated image")
+    args = parser.parse_args()
+
+    stub = StubWebUI(delay=args.overhead, delay_per_image=args.per_image).start()
+    print(f"{args.tasks} single-image tasks, {args.overhead} s per call + {args.per_image} s per image")
+    for batch_size in (1, 2, 4, 8):
+        run(stub, batch_size, args.tasks)
+    stub.stop()
@@ -0,0 +1,43 @@
+"""Request rate of /images/<filename> for cold clients and for warm clients revalidating with their ETag."""
+import os
+import time
+import logging
+import argparse
+import threading
+import numpy as np
+import requests
+from PIL import Image
+from werkzeug.serving import make_server
+
+from common import server
+
+def run(label, url, count, headers=None):
+    session = requests.Session()
+    received = 0
+    start = time.perf_counter()
+    for _ in range(count):
+        response = session.get(url, headers=headers)
+        received += len(response.content)
+    seconds = time.perf_counter() - start
+    print(f"{label:<6} {response.status_code}   {count / seconds:6.0f} req/s   {received / count / 1024:6.0f} KB/request")
+    return response
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--size", type=int, default=512)
+    args = parser.parse_args()
+
+    os.makedirs(server.IMAGES_FOLDER, exist_ok=True)
+    noise = np.random.default_rng(0).integers(0, 256, (args.size, args.size, 3), dtype=np.uint8)
+    Image.fromarray(noise).save(os.path.join(server.IMAGES_FOLDER, "bench.png"))
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)  # No access log line per request
+    http_server = make_server("127.0.0.1", 0, server.app, threaded=True)
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{http_server.server_port}/images/bench.png"
+
+    print(f"{args.requests} requests for a {args.size}x{args.size} px PNG")
+    response = run("cold", url, args.requests)
+    run("warm", url, args.requests, headers={"If-None-Match": response.headers["ETag"]})
+    http_server.shutdown()
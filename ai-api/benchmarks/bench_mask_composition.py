@@ -0,0 +1,51 @@
+"""Per-composition time of the preview mask pipelines at 512 to 4096 px."""
+import argparse
+import cv2
+import numpy as np
+
+from common import server, best_of
+
+def combine_masks(sam_mask, user_mask):
+    """The previous add step: addWeighted and a re-threshold."""
+    combined_mask = cv2.addWeighted(sam_mask, 1, user_mask, 1, 0)
+    _, combined_mask = cv2.threshold(combined_mask, 1, 255, cv2.THRESH_BINARY)
+    return combined_mask
+
+def subtract_masks(sam_mask, user_mask):
+    """The previous remove step: subtract and a re-threshold."""
+    subtracted_mask = cv2.subtract(sam_mask, user_mask)
+    _, subtracted_mask = cv2.threshold(subtracted_mask, 1, 255, cv2.THRESH_BINARY)
+    return subtracted_mask
+
+def old_chain(sam_mask, user_mask_add, user_mask_remove):
+    return subtract_masks(combine_masks(sam_mask, user_mask_add), user_mask_remove)
+
+def packbits(sam_mask, user_mask_add, user_mask_remove):
+    """Compose bit-packed masks and unpack the result back to 0/255 bytes."""
+    sam_bits, add_bits, remove_bits = (np.packbits(mask > 127) for mask in (sam_mask, user_mask_add, user_mask_remove))
+    composed_bits = (sam_bits | add_bits) & ~remove_bits
+    return np.unpackbits(composed_bits, count=sam_mask.size).reshape(sam_mask.shape) * np.uint8(255)
+
+def random_mask(size, seed):
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((size, size), dtype=np.uint8)
+    for _ in range(20):
+        x, y = (int(value) for value in rng.integers(0, size, 2))
+        cv2.circle(mask, (x, y), int(rng.integers(size // 40, size // 6)), 255, -1)
+    return mask
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print("Per composition (add + remove), best of", args.repeat)
+    print(f"{'size':<11} {'old chain':>10} {'packbits':>10} {'cv2 bitwise':>12}")
+    for size in (512, 1024, 2048, 4096):
+        masks = [random_mask(size, seed) for seed in range(3)]
+        pipelines = (old_chain, packbits, server.compose_masks)
+        results = [pipeline(*masks) for pipeline in pipelines]
+        assert all(np.array_equal(result, results[0]) for result in results)
+        times = [best_of(lambda: pipeline(*masks), args.repeat) * 1000 for pipeline in pipelines]
+        label = f"{size}x{size}"
+        print(f"{label:<11} {times[0]:7.2f} ms {times[1]:7.2f} ms {times[2]:9.2f} ms")
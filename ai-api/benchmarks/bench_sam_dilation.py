@@ -0,0 +1,35 @@
+"""Time of a SAM mask request with sequential, concurrent and in-process mask dilation."""
+import io
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+from common import server, best_of
+from stub_webui import StubWebUI, png_base64
+
+def run(label, image, repeat):
+    with contextlib.redirect_stdout(io.StringIO()):  # Hide the per-request log lines
+        seconds = best_of(lambda: server.generate_sam_mask(image, "sofa"), repeat)
+    print(f"{label:<12} {seconds * 1000:7.0f} ms")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds every stub WebUI call takes")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    stub = StubWebUI(delay=args.latency).start()
+    server.SD_URL = stub.url
+    image = png_base64(size=(512, 512))
+    print(f"3 masks, {args.latency} s per stub WebUI call")
+
+    server.SAM_LOCAL_DILATION = False
+    concurrent_executor = server.sd_request_executor
+    server.sd_request_executor = ThreadPoolExecutor(max_workers=1)
+    run("sequential", image, args.repeat)
+    server.sd_request_executor = concurrent_executor
+    run("concurrent", image, args.repeat)
+
+    server.SAM_LOCAL_DILATION = True
+    run("in-process", image, args.repeat)
+    stub.stop()
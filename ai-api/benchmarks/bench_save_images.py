@@ -0,0 +1,48 @@
+"""Time to save WebUI images: PIL decode and re-encode against writing the decoded bytes directly."""
+import io
+import os
+import base64
+import argparse
+import numpy as np
+from PIL import Image
+
+from common import server, best_of
+
+def save_images_reencoded(image_data_list, folder_name):
+    """The previous save_images, decoding every image with PIL and encoding it to PNG again."""
+    saved_paths = []
+    for image_data in image_data_list:
+        image_bytes = base64.b64decode(image_data.split(",", 1)[-1])
+        img = Image.open(io.BytesIO(image_bytes))
+        filename = server.generate_image_filename("png")
+        os.makedirs(f"static/{folder_name}", exist_ok=True)
+        img.save(os.path.join(f"static/{folder_name}", filename))
+        saved_paths.append(f"/static/{folder_name}/{filename}")
+    return saved_paths
+
+def generated_image_base64(size, seed):
+    """PNG with the smooth gradients and noise of a generated image, as the WebUI returns it."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size]
+    image = np.stack([x * 255 // size, y * 255 // size, (x + y) * 127 // size], axis=-1)
+    image = np.clip(image + rng.integers(-12, 12, image.shape), 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--images", type=int, default=8)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    images = [generated_image_base64(args.size, seed) for seed in range(args.images)]
+    print(f"{args.images} images of {args.size}x{args.size} px")
+    seconds = best_of(lambda: save_images_reencoded(images, "bench"), args.repeat)
+    print(f"{'PIL re-encode':<22} {seconds * 1000:7.0f} ms")
+    seconds = best_of(lambda: server.save_images(images, "bench"), args.repeat)
+    print(f"{'direct write':<22} {seconds * 1000:7.0f} ms")
+    server.image_writer_executor = None
+    seconds = best_of(lambda: server.save_images(images, "bench"), args.repeat)
+    print(f"{'direct write, 1 thread':<22} {seconds * 1000:7.0f} ms")
@@ -0,0 +1,59 @@
+"""Enqueue and dequeue throughput of the task queue, in memory and with the SQLite task database."""
+import os
+import time
+import argparse
+
+from common import server, work_directory
+
+def reset_task_store():
+    """Empty the task store between runs."""
+    with server.task_lock:
+        server.task_index.clear()
+        server.task_queue.clear()
+        server.running_tasks.clear()
+        server.task_history.clear()
+        server.client_finish_tags.clear()
+
+def enqueue(count, payload_bytes):
+    """Queue tasks carrying a base64-sized init image, spread over a few clients."""
+    payload = {"prompt": "room", "n_iter": 1, "init_images": ["A" * payload_bytes]}
+    for i in range(count):
+        server.queue_task(dict(payload), "img2img", f"client-{i % 8}")
+
+def dequeue():
+    """Take every task the way the workers do: dispatch, mark running, finish."""
+    while True:
+        with server.task_condition:
+            if not server.task_queue:
+                return
+            task = server.dispatch_next_task()
+            task["status"] = "running"
+            server.running_tasks[task["task_id"]] = task
+            server.persist_task(task)
+        server.finish_task(task, "success", [])
+
+def run(label, count, payload_bytes):
+    reset_task_store()
+    start = time.perf_counter()
+    enqueue(count, payload_bytes)
+    enqueue_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    dequeue()
+    dequeue_seconds = time.perf_counter() - start
+    print(f"{label:<10} enqueue {count / enqueue_seconds:8.0f} tasks/s   dequeue {count / dequeue_seconds:8.0f} tasks/s")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tasks", type=int, default=2000)
+    parser.add_argument("--payload-kb", type=int, default=50)
+    args = parser.parse_args()
+    # Keep every finished task in memory so eviction doesn't skew the numbers
+    server.TASK_HISTORY_MAX_TASKS = args.tasks
+
+    print(f"{args.tasks} tasks with {args.payload_kb} KB payloads")
+    run("memory", args.tasks, args.payload_kb * 1024)
+
+    server.TASK_DATABASE_FILE = os.path.join(work_directory, "tasks.db")
+    server.task_database = server.open_task_database()
+    run("sqlite", args.tasks, args.payload_kb * 1024)
+    server.task_database.close()
@@ -0,0 +1,28 @@
+import os
+import sys
+import time
+import tempfile
+
+AI_API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, AI_API_DIR)
+sys.path.insert(0, os.path.join(AI_API_DIR, "tests"))
+
+# Import the server without workers, benchmarks start them against stub backends
+os.environ["SD_URLS"] = ""
+os.chdir(AI_API_DIR)
+import server
+server.COLOR_NAME_CACHE_FILE = None  # Never write the cache of the checkout at exit
+server.TASK_ARCHIVE_FILE = None
+
+# Write images, masks and databases to a scratch folder instead of the checkout
+work_directory = tempfile.mkdtemp(prefix="ai-api-bench-")
+os.chdir(work_directory)
+
+def best_of(function, repeat=3):
+    """Run a function a few times and return the fastest wall time in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
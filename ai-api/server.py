@@ -2,19 +2,37 @@ import os
 import io
 import cv2
 import json
+import sqlite3
+import atexit
+import tempfile
 import uuid
+import hashlib
 import base64
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import validators
 import thecolorapi
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
+try:
+    import pillow_avif  # Registers AVIF with Pillow releases that don't ship it
+except ImportError:
+    pass
+try:
+    import pillow_jxl  # Registers JPEG XL with Pillow
+except ImportError:
+    pass
 from flask_cors import CORS
 from flask import Flask, request, jsonify, send_file, redirect, url_for, send_from_directory, render_template
 from datetime import datetime
 import threading
 import time
+import bisect
+import functools
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, wait
+from collections import OrderedDict
 
 app = Flask(__name__)
 CORS(app, resources={
@@ -30,26 +48,100 @@ CORS(app, resources={
 
 # Constant variables
 SD_URL = "http://127.0.0.1:7860"
+SD_URLS = [url for url in os.environ.get("SD_URLS", SD_URL).split(",") if url]  # Stable Diffusion WebUI instances tasks are dispatched to, comma-separated in $SD_URLS
+SD_BACKEND_MAX_FAILURES = 2              # Consecutive connection failures before a backend is marked unhealthy
+SD_BACKEND_RETRY_SECONDS = 10            # Delay between health checks of an unhealthy backend
+SD_MAX_BATCH_SIZE = 8                    # Most images generated by one coalesced txt2img call
+SD_HTTP_POOL_SIZE = 16                   # Keep-alive connections kept open per backend
+SD_CONNECT_TIMEOUT = 5                   # Seconds to wait for a backend connection
+SD_GENERATION_TIMEOUT = 900              # Seconds to wait for txt2img/img2img responses
+SD_SAM_TIMEOUT = 120                     # Seconds to wait for SAM responses
+SD_STATUS_TIMEOUT = 10                   # Seconds to wait for progress and health responses
+SD_GENERATION_WIDTH = 512                # Width of generated images
+SD_GENERATION_HEIGHT = 512               # Height of generated images
+CONTROLNET_LOCAL_PREPROCESSING = False   # Run the canny and color grid preprocessors here and send their maps with module "none"
+CONTROLNET_CACHE_MAX_ENTRIES = 64        # Preprocessed ControlNet maps kept for reused base images and style references
+SAM_MODEL_NAME = "sam_vit_b_01ec64.pth"
+DINO_MODEL_NAME = "GroundingDINO_SwinT_OGC (694MB)"
+DINO_BOX_THRESHOLD = 0.3
+SAM_CACHE_MAX_ENTRIES = 256              # SAM mask results kept for repeated image and prompt pairs
+SAM_DILATE_AMOUNT = 10                   # Diameter in pixels of the disk SAM masks are dilated by
+SAM_LOCAL_DILATION = True                # Dilate SAM masks in-process instead of calling /sam/dilate-mask
+SAM_BLEND_COLOR = (0.5488135, 0.71518937, 0.60276338, 0.6)  # RGBA overlay of blended images, as the SAM extension draws it
+TASK_LANE_WEIGHTS = {                    # Share of the backends given to each lane of tasks
+    "preview": 4,                        # Single-image generations
+    "txt2img": 2,
+    "img2img": 1,                        # Inpainting
+}
 SERVER_URL = "http://127.0.0.1:3500"
 IMAGES_FOLDER = 'static/images'
 if not os.path.exists(IMAGES_FOLDER):
     os.makedirs(IMAGES_FOLDER)
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+MASKS_FOLDER = 'static/masks'
+IMAGE_FORMATS = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP", "avif": "AVIF", "jxl": "JXL"}   # Formats images can be saved in, by PIL format name
+IMAGE_EXTENSIONS = {"png": "png", "jpeg": "jpg", "webp": "webp", "avif": "avif", "jxl": "jxl", "1bit": "1bit.png"}
+IMAGE_MIMETYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp", "avif": "image/avif", "jxl": "image/jxl", "1bit": "image/png"}
+RESULT_IMAGE_FORMATS = ["webp"]          # Lossy copies saved next to every generated PNG and offered by Accept header, best first (webp, avif, jxl)
+IMAGE_QUALITY_TIERS = {"high": 90, "medium": 75, "low": 50}  # Encoder quality of each tier of lossy copies
+IMAGE_QUALITY_TIER = "medium"            # Tier of the lossy copies saved with each result
+THUMBNAIL_SIZES = [128, 256]             # Longest side of the thumbnails saved with each result and served with ?size=
+IMAGE_CACHE_MAX_AGE = 365 * 24 * 60 * 60 # Seconds browsers may reuse a served image without revalidating, image filenames are never reused
+IMAGE_ETAG_CACHE_MAX_ENTRIES = 4096      # Content hashes of served images kept in memory
+IMAGE_WRITER_WORKERS = 4                 # Threads saving the images of one result in parallel (0 to save them one by one)
+RESULT_WRITER_WORKERS = 2                # Threads saving finished task results while the backends run their next tasks
+INPUT_NORMALIZATION = True               # Downscale input images to cover the generation resolution before encoding
+INPUT_CENTER_CROP = False                # Also center-crop normalized input images to the generation resolution
+INPUT_CACHE_MAX_ENTRIES = 64             # Normalized input images kept for uploads reused across SAM and generation calls
 app.config['IMAGES_FOLDER'] = IMAGES_FOLDER
-sdxl_styles = [
-    {
-        "name": "base",
-        "prompt": "{prompt}",
-        "negative_prompt": ""
-    },
-    {
-        "name": "3D Model",
-        "prompt": "professional 3d model of {prompt} . octane render, highly detailed, volumetric, dramatic lighting",
-        "negative_prompt": "ugly, deformed, noisy, low poly, blurry, worst quality, low quality, jpeg artifacts, ugly, duplicate, morbid, mutilated, out of frame, extra fingers, bad anatomy, bad proportions, extra limbs, cloned face, disfigured, gross proportions, malformed limbs, missing arms, missing legs, extra arms, extra legs, fused fingers, too many fingers, long neck, username, watermark, signature, naked, unclothed, sexual, nudity, pornography, erotic,inappropriate, explicit, offensive, violence"
-    }
-]
-task_queue = []
-task_history = []
+TASK_HISTORY_MAX_TASKS = 1000            # Finished tasks kept in memory
+TASK_HISTORY_TTL_SECONDS = 6 * 60 * 60   # Finished tasks not read for this long are evicted
+TASK_HISTORY_EVICT_INTERVAL_SECONDS = 60 # How often finished tasks past the TTL are evicted while no task finishes
+TASK_ARCHIVE_FILE = 'task_archive.jsonl' # Append-only archive of evicted tasks (None to disable)
+TASK_ARCHIVE_MAX_BYTES = 64 * 1024 * 1024  # Size at which the archive is rotated to TASK_ARCHIVE_FILE.1, replacing the previous rotation
+TASK_DATABASE_FILE = None                # SQLite file for a crash-safe task queue, e.g. 'tasks.db' (None to keep tasks in memory only)
+COLOR_NAMES_FILE = 'named-colors.json'   # Bundled named-color table used to name palette colors offline
+COLOR_NAME_CACHE_FILE = 'color_name_cache.json'  # Persisted thecolorapi names of palette colors (None to keep them in memory only)
+COLOR_NAME_CACHE_SAVE_DELAY_SECONDS = 2  # Lookups finishing within this long of each other are saved in one write
+COLOR_NAME_REMOTE_LOOKUP = True          # Look uncached colors up on thecolorapi
+COLOR_LOOKUP_WORKERS = 4                 # Concurrent thecolorapi lookups
+COLOR_LOOKUP_DEADLINE_SECONDS = 2        # Longest a prompt waits on thecolorapi before naming misses offline (0 to never wait)
+SDXL_STYLES_FILE = 'sdxl-styles.json'    # SDXL style presets, a list of {name, prompt, negative_prompt}
+SDXL_DEFAULT_STYLE = "3D Model"          # Style applied when a request doesn't select one
+# Task store: every task is indexed by task_id, pending order is kept in a sorted list
+task_lock = threading.RLock()
+task_condition = threading.Condition(task_lock)  # Signalled when tasks are queued or finished
+task_index = {}         # task_id -> task (queued, running and finished)
+task_queue = []         # (finish tag, ticket, task_id) of pending tasks, in fair-scheduled order
+running_tasks = {}      # task_id -> task currently running on a backend
+task_history = OrderedDict()  # task_id -> finished task, least recently read first
+archive_lock = threading.Lock()
+archive_index = {}      # task_id -> (archive path, byte offset) of archived tasks, guarded by archive_lock
+archive_index_file = None  # TASK_ARCHIVE_FILE the archive index was built for
+task_database = None    # SQLite connection when TASK_DATABASE_FILE is set, guarded by task_lock
+next_ticket = 1         # Ticket number handed to the next queued task
+virtual_time = 0.0      # Start tag of the most recently dispatched task
+client_finish_tags = {} # client_id -> finish tag of the client's last queued task
+sd_backends = []        # Backend state for each of SD_URLS, guarded by task_lock
+sam_cache = OrderedDict()  # SAM cache key -> saved mask paths, least recently used first
+sam_cache_lock = threading.Lock()
+sam_cache_stats = {"hits": 0, "misses": 0}
+controlnet_cache = OrderedDict()  # (module, width, height, image hash) -> preprocessed base64 map, least recently used first
+controlnet_cache_lock = threading.Lock()
+input_image_lock = threading.Lock()
+input_image_cache = OrderedDict()  # (upload hash, width, height, normalization, crop) -> encoded image, least recently used first
+input_image_stats = {"images": 0, "passthrough": 0, "normalized": 0, "reencoded": 0, "cache_hits": 0, "bytes_in": 0, "bytes_out": 0, "ms": 0.0}
+color_name_cache = {}   # "#rrggbb" -> thecolorapi name
+color_name_lock = threading.Lock()
+color_name_save_lock = threading.Lock()
+color_name_save_timer = None  # Pending save of the color name cache, guarded by color_name_lock
+color_lookups_pending = {}  # Hex color -> future of its running thecolorapi lookup
+sdxl_styles = {}        # Style name -> prompt prefix, prompt suffix and negative prompt
+image_etags = OrderedDict()  # (file path, mtime, size) -> content hash of a served image, least recently used first
+image_etag_lock = threading.Lock()
+image_writer_executor = ThreadPoolExecutor(max_workers=IMAGE_WRITER_WORKERS, thread_name_prefix="image-writer") if IMAGE_WRITER_WORKERS else None
+result_writer_executor = ThreadPoolExecutor(max_workers=RESULT_WRITER_WORKERS, thread_name_prefix="result-writer")
+color_lookup_executor = ThreadPoolExecutor(max_workers=COLOR_LOOKUP_WORKERS, thread_name_prefix="color-lookup")
 
 # File-related functions
 def allowed_file(filename):
@@ -58,33 +150,106 @@ def allowed_file(filename):
 def generate_image_filename(extension="png"):
     return f"{uuid.uuid4()}.{extension}"
 
-def load_and_encode_image(image_file, from_url=False):
-    """Load an image using PIL and encode it to base64 PNG for ControlNet."""
+def read_image_bytes(image_file, from_url=False):
+    """Read the raw bytes of an uploaded file, a file path or an image URL."""
+    if from_url:
+        response = requests.get(image_file)
+        response.raise_for_status()
+        return response.content
+    if isinstance(image_file, str):
+        with open(image_file, "rb") as f:
+            return f.read()
+    return image_file.read()
+
+def input_cover_size(width, height):
+    """Smallest size covering the generation resolution at the image's aspect ratio, never larger than the image."""
+    k = max(SD_GENERATION_WIDTH / width, SD_GENERATION_HEIGHT / height)
+    if k >= 1:
+        return width, height
+    return max(SD_GENERATION_WIDTH, int(round(width * k))), max(SD_GENERATION_HEIGHT, int(round(height * k)))
+
+def exif_orientation(image):
+    """EXIF orientation of a PIL image, 1 when its pixels are stored upright."""
     try:
-        # Check if image is a URL or file
-        if from_url:
-            response = requests.get(image_file)
-            response.raise_for_status()
-            image = Image.open(BytesIO(response.content)).convert('RGB')
-        else:
-            # Load image with PIL
-            image = Image.open(image_file).convert('RGB')
+        return image.getexif().get(0x0112, 1)
+    except Exception:
+        return 1
+
+def upright_size(image):
+    """Size of a PIL image once turned upright by its EXIF orientation."""
+    return image.size[::-1] if exif_orientation(image) in (5, 6, 7, 8) else image.size
+
+def normalize_input_image(image):
+    """Turn a PIL image upright, downscale it to cover the generation resolution and optionally center-crop it, as an RGB array."""
+    size = input_cover_size(*upright_size(image))
+    # JPEGs are decoded straight at a reduced scale no smaller than the target, in their stored orientation
+    image.draft('RGB', size if upright_size(image) == image.size else size[::-1])
+    image_np = np.array(ImageOps.exif_transpose(image).convert('RGB'))
+    if image_np.shape[1::-1] != size:
+        image_np = cv2.resize(image_np, size, interpolation=cv2.INTER_AREA)
+    if INPUT_CENTER_CROP:
+        width, height = min(size[0], SD_GENERATION_WIDTH), min(size[1], SD_GENERATION_HEIGHT)
+        left, top = (size[0] - width) // 2, (size[1] - height) // 2
+        image_np = image_np[top:top + height, left:left + width]
+    return image_np
 
-        # Convert PIL image to a numpy array
-        image_np = np.array(image)
+def load_and_encode_image(image_file, from_url=False):
+    """Load an image, normalize it to the generation resolution and encode it to base64 for the WebUI."""
+    try:
+        start = time.perf_counter()
+        image_bytes = read_image_bytes(image_file, from_url)
+
+        # The same upload reaches SAM and next-generation calls, so it is only normalized once
+        cache_key = (hashlib.blake2b(image_bytes, digest_size=20).hexdigest(), SD_GENERATION_WIDTH, SD_GENERATION_HEIGHT, INPUT_NORMALIZATION, INPUT_CENTER_CROP)
+        with input_image_lock:
+            encoded_image = input_image_cache.get(cache_key)
+            if encoded_image:
+                input_image_cache.move_to_end(cache_key)
+        if encoded_image:
+            record_input_image_metrics(len(image_bytes), len(encoded_image) * 3 // 4, "cache_hits", time.perf_counter() - start)
+            return encoded_image
 
-        # Convert from RGB to BGR for OpenCV (since OpenCV uses BGR by default)
-        image_np_bgr = cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR)
+        # PIL only parses the header here, pixels are decoded on demand
+        image = Image.open(BytesIO(image_bytes))
+        width, height = upright_size(image)
+        if INPUT_NORMALIZATION:
+            target_size = input_cover_size(width, height)
+            if INPUT_CENTER_CROP:
+                target_size = (min(target_size[0], SD_GENERATION_WIDTH), min(target_size[1], SD_GENERATION_HEIGHT))
+        else:
+            target_size = (width, height)
 
-        # Encode into PNG using OpenCV and then base64
-        retval, bytes_img = cv2.imencode('.png', image_np_bgr)
-        encoded_image = base64.b64encode(bytes_img).decode('utf-8')
-        
+        if image.format in ("PNG", "JPEG") and image.mode == "RGB" and target_size == (width, height) and exif_orientation(image) == 1:
+            # Already-valid small upright RGB PNGs and JPEGs are passed through untouched
+            encoded_bytes = image_bytes
+            outcome = "passthrough"
+        else:
+            # The WebUI ignores EXIF orientation, so rotated photos are turned upright before encoding
+            image_np = normalize_input_image(image) if INPUT_NORMALIZATION else np.array(ImageOps.exif_transpose(image).convert('RGB'))
+            # Convert from RGB to BGR for OpenCV and encode into PNG
+            retval, encoded_bytes = cv2.imencode('.png', cv2.cvtColor(image_np, cv2.COLOR_RGB2BGR))
+            outcome = "normalized" if target_size != (width, height) else "reencoded"
+        encoded_image = base64.b64encode(encoded_bytes).decode('utf-8')
+
+        with input_image_lock:
+            input_image_cache[cache_key] = encoded_image
+            while len(input_image_cache) > INPUT_CACHE_MAX_ENTRIES:
+                input_image_cache.popitem(last=False)
+        record_input_image_metrics(len(image_bytes), len(encoded_bytes), outcome, time.perf_counter() - start)
         return encoded_image
     except Exception as e:
         print(f"Error loading and encoding image: {e}")
         return None
 
+def record_input_image_metrics(bytes_in, bytes_out, outcome, seconds):
+    """Count an encoded input image in the input image metrics."""
+    with input_image_lock:
+        input_image_stats["images"] += 1
+        input_image_stats[outcome] += 1
+        input_image_stats["bytes_in"] += bytes_in
+        input_image_stats["bytes_out"] += bytes_out
+        input_image_stats["ms"] += seconds * 1000
+
 def decode_base64_image(base64_str):
     """Decode a base64 image string and convert it to a NumPy array."""
     try:
@@ -107,6 +272,15 @@ def decode_base64_image(base64_str):
         print(f"Error decoding base64 image: {e}")
         return None
 
+def image_pixel_hash(image_base64):
+    """Hash the decoded pixels of a base64 image, so re-encodings of one image share a hash."""
+    image_np = cv2.imdecode(np.frombuffer(base64.b64decode(extract_base64_data(image_base64)), np.uint8), cv2.IMREAD_UNCHANGED)
+    if image_np is None:
+        return None
+    pixel_hash = hashlib.blake2b(str(image_np.shape).encode(), digest_size=20)
+    pixel_hash.update(np.ascontiguousarray(image_np).data)
+    return pixel_hash.hexdigest()
+
 def image_path_to_base64(image_path):
     # Check if image_path is valid and the file is allowed
     if image_path and allowed_file(image_path):
@@ -133,115 +307,121 @@ def extract_base64_data(data_url):
         return data_url.split(",", 1)[1]  # Get the base64 part only
     return data_url 
 
-def save_images(image_data_list, folder_name):
-    """Helper function to save images and return file paths."""
-    saved_paths = []
-    for image_data in image_data_list:
-        if image_data:
-            image_bytes = base64.b64decode(image_data.split(",", 1)[-1])
-            img = Image.open(io.BytesIO(image_bytes))
-            filename = generate_image_filename("png")
-            folder_path = f"static/{folder_name}"
-            os.makedirs(folder_path, exist_ok=True)
-            image_path = os.path.join(f"static/{folder_name}", filename)
-            img.save(image_path)
-            saved_paths.append(f"/static/{folder_name}/{filename}")
-    return saved_paths
-
-def save_images_agent_scheduler(image_data_list, folder_name):
-    """Helper function to save images and return file paths."""
-    saved_paths = []
-    for image_data in image_data_list:
-        if image_data.get("image"):  # Check if "image" key exists
-            # Access the base64 image string from the dictionary
-            image_str = image_data["image"]
-            # Decode the base64 image data
-            image_bytes = base64.b64decode(image_str.split(",", 1)[-1])
-            img = Image.open(io.BytesIO(image_bytes))
-            filename = generate_image_filename("png")
-            folder_path = f"static/{folder_name}"
-            os.makedirs(folder_path, exist_ok=True)
-            image_path = os.path.join(folder_path, filename)
-            img.save(image_path)
-            saved_paths.append(f"/static/{folder_name}/{filename}")
-    return saved_paths
-
-def save_image_from_base64(image_base64, folder_name):
-    """Helper function to save a combined mask and return its file path."""
-    # Decode the base64 image
-    image_bytes = base64.b64decode(image_base64)
-    img = Image.open(io.BytesIO(image_bytes))
-
-    # Generate filename and save path
-    filename = generate_image_filename("png")
+def image_bytes_format(image_bytes):
+    """Tell the format of encoded image bytes from their header, or None if it isn't a complete PNG, JPEG or WebP."""
+    if image_bytes[:8] == b"\x89PNG\r\n\x1a\n":
+        # The IHDR chunk comes first and IEND last, so truncated PNGs are caught without decoding
+        return "png" if image_bytes[12:16] == b"IHDR" and image_bytes[-8:-4] == b"IEND" else None
+    if image_bytes[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+def save_image_bytes(image_bytes, folder_name, image_format="png"):
+    """Write encoded image bytes to disk as they are, re-encoding only to convert formats, and return its path."""
+    if image_bytes_format(image_bytes) != image_format:
+        img = Image.open(io.BytesIO(image_bytes))
+        if image_format == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        buffer = io.BytesIO()
+        img.save(buffer, format=IMAGE_FORMATS[image_format])
+        image_bytes = buffer.getvalue()
+
+    filename = generate_image_filename(IMAGE_EXTENSIONS[image_format])
     folder_path = f"static/{folder_name}"
-    os.makedirs(folder_path, exist_ok=True)  # Ensure the folder exists
+    os.makedirs(folder_path, exist_ok=True)
     image_path = os.path.join(folder_path, filename)
-
-    # Save the image to the specified folder
-    img.save(image_path)
-    print(f"Image saved at: {image_path}")
-
+    # Written under a temporary name first so a half-written image is never served
+    with open(f"{image_path}.tmp", "wb") as f:
+        f.write(image_bytes)
+    os.replace(f"{image_path}.tmp", image_path)
     return f"/static/{folder_name}/{filename}"
 
-def fix_base64_padding(base64_string):
-    """Fix incorrect padding in base64 string."""
-    return base64_string + '=' * (4 - len(base64_string) % 4)
-
-def make_black_transparent(image_path):
-    """Convert black pixels to transparent in the image at the given path."""
-    try:
-        if allowed_file(image_path):
-            # Input is a valid file path
-            image_path = os.path.join(app.root_path, image_path.lstrip('/'))
-            if os.path.exists(image_path):
-                img = Image.open(image_path).convert("RGBA")
-        elif isinstance(image_path, str):
-            if image_path.strip().startswith("data:image"):
-                # Input is base64 with a header
-                header, encoded = image_path.split(",", 1)
-                img_bytes = base64.b64decode(encoded)
-            else:
-                # Input is raw base64s
-                try:
-                    img_bytes = base64.b64decode(image_path)
-                except Exception:
-                    print("Invalid base64 input.")
-                    return None
-            # Load image from bytes
-            img = Image.open(io.BytesIO(img_bytes)).convert("RGBA")
-        else:
-            print("Invalid image input: not base64 or a valid file path.")
-            return None
-
-        # Convert the image to a NumPy array
-        image_np = np.array(img)
-
-        # Create a mask where black pixels are found
-        black_pixels_mask = (image_np[:, :, 0] < 10) & (image_np[:, :, 1] < 10) & (image_np[:, :, 2] < 10)
-        
-        # Set those pixels to transparent
-        image_np[black_pixels_mask] = (255, 255, 255, 0)  # Fully transparent
-
-        # Convert back to PIL image
-        img = Image.fromarray(image_np, 'RGBA')
+def save_image_bytes_list(image_bytes_list, folder_name, image_format="png"):
+    """Save several encoded images, in parallel on the image writer pool when it is enabled."""
+    if image_writer_executor and len(image_bytes_list) > 1:
+        return list(image_writer_executor.map(lambda image_bytes: save_image_bytes(image_bytes, folder_name, image_format), image_bytes_list))
+    return [save_image_bytes(image_bytes, folder_name, image_format) for image_bytes in image_bytes_list]
 
-        # Save the modified image to a bytes buffer
-        buffered = io.BytesIO()
-        img.save(buffered, format="PNG")
-        buffered.seek(0)
-
-        # Get the base64 encoding of the modified image
-        image_base64 = base64.b64encode(buffered.read()).decode('utf-8')
-        image_base64 = fix_base64_padding(image_base64)
-
-        # Save the image using the helper function
-        output_path = save_image_from_base64(image_base64, "masks")
-        return output_path  # Return the path of the saved image
+def save_images(image_data_list, folder_name, image_format="png"):
+    """Helper function to save images and return file paths."""
+    image_bytes_list = [base64.b64decode(image_data.split(",", 1)[-1]) for image_data in image_data_list if image_data]
+    return save_image_bytes_list(image_bytes_list, folder_name, image_format)
 
-    except Exception as e:
-        print(f"Error making black transparent: {e}")
+def save_images_agent_scheduler(image_data_list, folder_name, image_format="png"):
+    """Helper function to save images and return file paths."""
+    # Access the base64 image string of every dictionary that has one
+    image_bytes_list = [base64.b64decode(image_data["image"].split(",", 1)[-1]) for image_data in image_data_list if image_data.get("image")]
+    return save_image_bytes_list(image_bytes_list, folder_name, image_format)
+
+def image_format_available(image_format):
+    """Check if PIL can encode a format, AVIF and JPEG XL needing their optional plugins."""
+    Image.init()
+    return IMAGE_FORMATS.get(image_format) in Image.SAVE
+
+def variant_file_path(file_path, variant, tier=None, size=None):
+    """Path of a saved image's variant: another format, quality tier of a lossy format, or thumbnail size."""
+    stem = os.path.splitext(file_path)[0]
+    if size:
+        stem = f"{stem}.{size}"
+    # Lossless formats have no quality tiers
+    if tier and tier != IMAGE_QUALITY_TIER and variant not in ("png", "1bit"):
+        stem = f"{stem}.{tier}"
+    return f"{stem}.{IMAGE_EXTENSIONS[variant]}"
+
+def is_original_image(filename):
+    """Check if a saved image is an original, <uuid>.<ext>, rather than one of its variants."""
+    return "." not in os.path.splitext(os.path.basename(filename))[0]
+
+def encode_image_variant(file_path, variant, tier=None, size=None):
+    """Encode a variant of a saved image next to it and return its path, or None if it can't be made."""
+    variant_path = variant_file_path(file_path, variant, tier, size)
+    if os.path.exists(variant_path):
+        return variant_path
+    img = Image.open(file_path)
+    if variant == "1bit":
+        # Only masks that are purely black and white survive the trip to 1 bit per pixel
+        mask = np.asarray(img.convert("L"))
+        if not np.isin(mask, (0, 255)).all():
+            return None
+        img, options = Image.fromarray(mask).convert("L"), {"format": "PNG", "optimize": True}
+    elif image_format_available(variant):
+        if variant == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        options = {"format": IMAGE_FORMATS[variant]}
+        if variant not in ("png", "1bit"):
+            options["quality"] = IMAGE_QUALITY_TIERS[tier or IMAGE_QUALITY_TIER]
+    else:
+        print(f"Image format {variant} is not available")
         return None
+    if size:
+        # Thumbnails keep the aspect ratio and fit in a size x size box
+        img.thumbnail((size, size))
+    if variant == "1bit":
+        img = img.point(lambda value: 255 if value > 127 else 0).convert("1", dither=Image.NONE)
+    # Concurrent first requests for a variant each write their own temporary file
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(variant_path), suffix=".tmp", delete=False) as f:
+        img.save(f, **options)
+    os.chmod(f.name, 0o644)
+    os.replace(f.name, variant_path)
+    return variant_path
+
+def save_image_variant(image_path, variant, size=None):
+    """Save a variant next to an image saved at a /static/... path, logging failures."""
+    try:
+        encode_image_variant(image_path.lstrip('/'), variant, size=size)
+    except Exception as e:
+        print(f"Error saving {variant} variant of {image_path}: {e}")
+
+def save_image_variants(image_paths, variants, sizes=(None,)):
+    """Save variants and thumbnails next to saved images, in parallel on the image writer pool when it is enabled."""
+    jobs = [(image_path, variant, size) for image_path in image_paths for variant in variants for size in sizes]
+    if image_writer_executor and len(jobs) > 1:
+        list(image_writer_executor.map(lambda job: save_image_variant(*job), jobs))
+    else:
+        for job in jobs:
+            save_image_variant(*job)
 
 # Color name functions using thecolorapi
 def thecolorapi_hex_to_color_name(hex_code):
@@ -252,9 +432,130 @@ def thecolorapi_hex_to_color_name(hex_code):
         print(f"Error retrieving color name: {e}")
         return hex_code  # Return the original hex code if there's an error
 
+def normalize_hex_code(hex_code):
+    """Normalize a hex color to lowercase "#rrggbb", or None if it isn't one."""
+    if not isinstance(hex_code, str):
+        return None
+    value = hex_code.strip().lower().lstrip('#')
+    if len(value) == 3:
+        value = "".join(char * 2 for char in value)
+    if len(value) != 6 or any(char not in "0123456789abcdef" for char in value):
+        return None
+    return f"#{value}"
+
+def hex_codes_to_lab(hex_codes):
+    """Convert normalized hex colors to an (N, 3) array of CIELAB colors."""
+    rgb = np.array([[int(hex_code[i:i + 2], 16) for i in (1, 3, 5)] for hex_code in hex_codes], dtype=np.float32)
+    return cv2.cvtColor(rgb.reshape(1, -1, 3) / 255, cv2.COLOR_RGB2LAB).reshape(-1, 3)
+
+def load_named_colors():
+    """Load the bundled named-color table as parallel name and CIELAB arrays."""
+    try:
+        with open(COLOR_NAMES_FILE) as f:
+            named_colors = json.load(f)
+        return list(named_colors.keys()), hex_codes_to_lab([normalize_hex_code(hex_code) for hex_code in named_colors.values()])
+    except Exception as e:
+        print(f"Error loading named colors: {e}")
+        return [], np.empty((0, 3), dtype=np.float32)
+
+named_color_names, named_color_lab = load_named_colors()
+
+def nearest_color_names(hex_codes):
+    """Name normalized hex colors offline by their nearest bundled color in CIELAB."""
+    if not named_color_names:
+        return list(hex_codes)
+    distances = ((hex_codes_to_lab(hex_codes)[:, None, :] - named_color_lab[None, :, :]) ** 2).sum(axis=2)
+    return [named_color_names[i] for i in distances.argmin(axis=1)]
+
+def load_color_name_cache():
+    """Load the persisted thecolorapi names into the color name cache."""
+    if not COLOR_NAME_CACHE_FILE or not os.path.exists(COLOR_NAME_CACHE_FILE):
+        return
+    try:
+        with open(COLOR_NAME_CACHE_FILE) as f:
+            color_name_cache.update(json.load(f))
+        print(f"Loaded {len(color_name_cache)} cached color names")
+    except Exception as e:
+        print(f"Error loading color name cache: {e}")
+
+def save_color_name_cache():
+    """Write the color name cache to disk, replacing the previous file atomically."""
+    global color_name_save_timer
+    if not COLOR_NAME_CACHE_FILE:
+        return
+    try:
+        # One writer at a time, each through its own temporary file
+        with color_name_save_lock:
+            with color_name_lock:
+                color_name_save_timer = None
+                names = dict(color_name_cache)
+            with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(os.path.abspath(COLOR_NAME_CACHE_FILE)), suffix=".tmp", delete=False) as f:
+                json.dump(names, f, indent=4)
+            os.replace(f.name, COLOR_NAME_CACHE_FILE)
+    except Exception as e:
+        print(f"Error saving color name cache: {e}")
+
+def schedule_color_name_cache_save():
+    """Save the color name cache shortly, so a burst of lookups is written once."""
+    global color_name_save_timer
+    if not COLOR_NAME_CACHE_FILE:
+        return
+    with color_name_lock:
+        if color_name_save_timer is None:
+            color_name_save_timer = threading.Timer(COLOR_NAME_CACHE_SAVE_DELAY_SECONDS, save_color_name_cache)
+            color_name_save_timer.daemon = True
+            color_name_save_timer.start()
+
+def lookup_color_name(hex_code):
+    """Ask thecolorapi for the name of a normalized hex color and cache it."""
+    try:
+        name = thecolorapi_hex_to_color_name(hex_code)
+        if name != hex_code:
+            with color_name_lock:
+                color_name_cache[hex_code] = name
+            schedule_color_name_cache_save()
+    finally:
+        with color_name_lock:
+            color_lookups_pending.pop(hex_code, None)
+
+def resolve_color_names(color_palette):
+    """Name every palette color from the cache, thecolorapi within the lookup deadline, or offline."""
+    hex_codes = [normalize_hex_code(hex_code) for hex_code in color_palette]
+    with color_name_lock:
+        names = [color_name_cache.get(hex_code) if hex_code else hex_code for hex_code in hex_codes]
+        misses = list(dict.fromkeys(hex_code for hex_code, name in zip(hex_codes, names) if hex_code and name is None))
+        lookups = []
+        if COLOR_NAME_REMOTE_LOOKUP:
+            # Misses already being looked up for another request are waited on, not asked for twice
+            for hex_code in misses:
+                if hex_code not in color_lookups_pending:
+                    color_lookups_pending[hex_code] = color_lookup_executor.submit(lookup_color_name, hex_code)
+                lookups.append(color_lookups_pending[hex_code])
+
+    if not misses:
+        return [name if name is not None else original for name, original in zip(names, color_palette)]
+
+    # All misses are looked up concurrently under one deadline, late answers still land in the cache
+    if lookups and COLOR_LOOKUP_DEADLINE_SECONDS > 0:
+        wait(lookups, timeout=COLOR_LOOKUP_DEADLINE_SECONDS)
+    with color_name_lock:
+        resolved = {hex_code: color_name_cache[hex_code] for hex_code in misses if hex_code in color_name_cache}
+
+    # Colors thecolorapi didn't name in time are named from the bundled table
+    unresolved = [hex_code for hex_code in misses if hex_code not in resolved]
+    if unresolved:
+        resolved.update(zip(unresolved, nearest_color_names(unresolved)))
+    names = [resolved.get(hex_code, name) for hex_code, name in zip(hex_codes, names)]
+
+    # Anything that isn't a hex color is passed through as is
+    return [name if name is not None else original for name, original in zip(names, color_palette)]
+
+load_color_name_cache()
+atexit.register(save_color_name_cache)
+
 def build_prompt_with_color(base_prompt, color_palette):
     try:
-        color_names = [thecolorapi_hex_to_color_name(hex_code) for hex_code in color_palette]
+        color_names = resolve_color_names(color_palette)
         colors_description = ", ".join(color_names)
         return f"{base_prompt} with colors {colors_description}"
     except Exception as e:
@@ -262,110 +563,579 @@ def build_prompt_with_color(base_prompt, color_palette):
         return base_prompt
 
 # SDXL Styles with color function
+def load_sdxl_styles():
+    """Load the SDXL style presets, splitting each prompt template around {prompt} once."""
+    try:
+        with open(SDXL_STYLES_FILE) as f:
+            styles = json.load(f)
+    except Exception as e:
+        print(f"Error loading SDXL styles: {e}")
+        return
+    for style in styles:
+        prefix, placeholder, suffix = style["prompt"].partition("{prompt}")
+        if not placeholder:
+            # Templates without a placeholder are appended to the prompt
+            prefix, suffix = "", f", {style['prompt']}" if style["prompt"] else ""
+        sdxl_styles[style["name"]] = {
+            "prefix": prefix,
+            "suffix": suffix,
+            "negative_prompt": style.get("negative_prompt", ""),
+        }
+    print(f"Loaded {len(sdxl_styles)} SDXL styles")
+
+load_sdxl_styles()
+
 def apply_sdxl_style(selected_style_name, prompt, color_palette=None):
     """Apply the SDXL style to the user prompt and insert color description right after the {prompt}."""
-    selected_style = next((style for style in sdxl_styles if style["name"] == selected_style_name), None)
+    selected_style = sdxl_styles.get(selected_style_name)
 
-    if selected_style:
-        # Build the color description if the color palette is provided
-        if color_palette:
-            color_names = [thecolorapi_hex_to_color_name(hex_code) for hex_code in color_palette]
-            colors_description = f" with colors {', '.join(color_names)}"
-        else:
-            colors_description = ""
-
-        # Replace the {prompt} placeholder with the user input and insert the color description
-        prompt = selected_style["prompt"].replace("{prompt}", f"{prompt}{colors_description}")
-        negative_prompt = selected_style["negative_prompt"]
+    # Build the color description if the color palette is provided
+    if color_palette:
+        color_names = resolve_color_names(color_palette)
+        colors_description = f" with colors {', '.join(color_names)}"
+    else:
+        colors_description = ""
 
-        return prompt, negative_prompt
+    if selected_style:
+        # Wrap the user input and color description in the style's template
+        prompt = f"{selected_style['prefix']}{prompt}{colors_description}{selected_style['suffix']}"
+        return prompt, selected_style["negative_prompt"]
     else:
         # In case no style is found, apply color palette to base prompt (if color_palette exists)
-        if color_palette:
-            color_names = [thecolorapi_hex_to_color_name(hex_code) for hex_code in color_palette]
-            colors_description = f" with colors {', '.join(color_names)}"
-            prompt = f"{prompt}{colors_description}"
+        print(f"Unknown SDXL style: {selected_style_name}")
         # Return original prompt with no negative prompt
-        return prompt, ""
+        return f"{prompt}{colors_description}", ""
+
+# WEBUI HTTP SESSION
+def create_sd_session():
+    """Create the pooled keep-alive session shared by every WebUI call."""
+    # Only connection failures and gateway errors on GETs are retried, never generations
+    retry = Retry(total=2, connect=2, read=0, status=2, backoff_factor=0.5,
+                  status_forcelist=(502, 503, 504), allowed_methods=frozenset({"GET"}))
+    adapter = HTTPAdapter(pool_connections=max(len(SD_URLS), 1), pool_maxsize=SD_HTTP_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+sd_session = create_sd_session()
+sd_request_executor = ThreadPoolExecutor(max_workers=SD_HTTP_POOL_SIZE, thread_name_prefix="sd-request")  # Concurrent WebUI calls within one request
+
+def sd_connection_metrics():
+    """Requests sent and connections opened per WebUI host, with the connection reuse rate."""
+    metrics = {}
+    for adapter in set(sd_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            if pool is None:
+                continue
+            host = f"{pool.scheme}://{pool.host}:{pool.port}"
+            metrics[host] = {
+                "requests": pool.num_requests,
+                "connections": pool.num_connections,
+                "reuse_rate": round(1 - pool.num_connections / pool.num_requests, 4) if pool.num_requests else 0.0,
+            }
+    return metrics
 
 # SCHEDULER
-def execute_task(task, type):
-    """Execute the task based on its parameters with retry logic."""
-    task_id = task.get("task_id")
-    task["status"] = "running"
+def task_snapshot(task):
+    """Copy a task for the API, deriving its queue position from the fair-scheduled order."""
+    snapshot = {key: value for key, value in task.items() if not key.startswith("_")}
+    if task["status"] == "pending":
+        # Running tasks are at position 1, so while any run the next task to dispatch is at position 2
+        snapshot["position"] = bisect.bisect_left(task_queue, task["_schedule_key"]) + (2 if running_tasks else 1)
+    elif task["status"] == "running":
+        snapshot["position"] = 1
+    return snapshot
+
+def compact_task_parameters(parameters):
+    """Drop the base64 image payloads from a finished task's parameters."""
+    if not isinstance(parameters, dict):
+        return parameters
+    compacted = {key: value for key, value in parameters.items() if key not in ("init_images", "mask")}
+    controlnet = parameters.get("alwayson_scripts", {}).get("controlnet")
+    if controlnet:
+        args = [{key: value for key, value in arg.items() if key != "image"} for arg in controlnet.get("args", [])]
+        compacted["alwayson_scripts"] = {**parameters["alwayson_scripts"], "controlnet": {**controlnet, "args": args}}
+    return compacted
+
+def load_archive_index():
+    """Index the task archive and its rotation by task_id, once per archive file. Call with archive_lock held."""
+    global archive_index_file
+    if archive_index_file == TASK_ARCHIVE_FILE:
+        return
+    archive_index.clear()
+    archive_index_file = TASK_ARCHIVE_FILE
+    for path in (f"{TASK_ARCHIVE_FILE}.1", TASK_ARCHIVE_FILE):
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as archive_file:
+            offset = 0
+            for line in archive_file:
+                try:
+                    archive_index[json.loads(line)["task_id"]] = (path, offset)
+                except (ValueError, KeyError):
+                    pass  # Skip a line cut short by a crash
+                offset += len(line)
+
+def rotate_task_archive():
+    """Move a full archive to TASK_ARCHIVE_FILE.1, dropping the tasks of the previous rotation. Call with archive_lock held."""
+    rotated_path = f"{TASK_ARCHIVE_FILE}.1"
+    os.replace(TASK_ARCHIVE_FILE, rotated_path)
+    for task_id, (path, offset) in list(archive_index.items()):
+        if path == rotated_path:
+            del archive_index[task_id]
+        else:
+            archive_index[task_id] = (rotated_path, offset)
+
+def archive_tasks(tasks):
+    """Append evicted tasks to the on-disk task archive and index their offsets."""
+    if not TASK_ARCHIVE_FILE or not tasks:
+        return
+    try:
+        with archive_lock:
+            load_archive_index()
+            with open(TASK_ARCHIVE_FILE, "ab") as archive_file:
+                for task in tasks:
+                    archive_index[task["task_id"]] = (TASK_ARCHIVE_FILE, archive_file.tell())
+                    archive_file.write((json.dumps(task_snapshot(task)) + "\n").encode("utf-8"))
+                archive_size = archive_file.tell()
+            if archive_size >= TASK_ARCHIVE_MAX_BYTES:
+                rotate_task_archive()
+    except Exception as e:
+        print(f"Error archiving tasks: {e}")
+
+def find_archived_task(task_id):
+    """Look up an evicted task in the on-disk task archive by its indexed offset."""
+    if not TASK_ARCHIVE_FILE:
+        return None
+    try:
+        with archive_lock:
+            load_archive_index()
+            location = archive_index.get(task_id)
+            if not location:
+                return None
+            path, offset = location
+            with open(path, "rb") as archive_file:
+                archive_file.seek(offset)
+                return json.loads(archive_file.readline())
+    except Exception as e:
+        print(f"Error reading task archive: {e}")
+    return None
+
+def open_task_database():
+    """Open the SQLite task database in WAL mode and create its table."""
+    connection = sqlite3.connect(TASK_DATABASE_FILE, check_same_thread=False, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("""
+        CREATE TABLE IF NOT EXISTS tasks (
+            task_id TEXT PRIMARY KEY,
+            ticket INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            data TEXT NOT NULL
+        )
+    """)
+    connection.execute("CREATE INDEX IF NOT EXISTS tasks_ticket ON tasks (ticket)")
+    return connection
+
+def persist_task(task):
+    """Write a task through to the task database, if one is configured."""
+    if task_database is None:
+        return
+    try:
+        data = {key: value for key, value in task.items() if not key.startswith("_")}
+        data["_client_id"] = task.get("_client_id")
+        with task_lock:
+            task_database.execute(
+                "INSERT OR REPLACE INTO tasks (task_id, ticket, status, data) VALUES (?, ?, ?, ?)",
+                (task["task_id"], task["_ticket"], task["status"], json.dumps(data))
+            )
+    except Exception as e:
+        print(f"Error persisting task {task.get('task_id')}: {e}")
+
+def delete_persisted_tasks(task_ids):
+    """Remove evicted tasks from the task database, if one is configured."""
+    if task_database is None or not task_ids:
+        return
+    try:
+        with task_lock:
+            task_database.executemany("DELETE FROM tasks WHERE task_id = ?", [(task_id,) for task_id in task_ids])
+    except Exception as e:
+        print(f"Error deleting persisted tasks: {e}")
+
+def recover_tasks():
+    """Reload the task queue and history from the task database after a restart."""
+    global task_database, next_ticket
+    task_database = open_task_database()
+    with task_lock:
+        rows = task_database.execute("SELECT ticket, status, data FROM tasks ORDER BY ticket").fetchall()
+        for ticket, status, data in rows:
+            task = json.loads(data)
+            task["_ticket"] = ticket
+            task_index[task["task_id"]] = task
+            if status in ("pending", "running"):
+                # Tasks that were running when the process stopped are run again
+                task["status"] = "pending"
+                task["_lane"] = task_lane(task["type"], task["parameters"])
+                task["_batch_key"] = task_batch_key(task["type"], task["parameters"])
+                schedule_task(task)
+            else:
+                task.pop("_client_id", None)
+                task["_accessed_at"] = time.monotonic()
+                task_history[task["task_id"]] = task
+            next_ticket = max(next_ticket, ticket + 1)
+        task_database.execute("UPDATE tasks SET status = 'pending' WHERE status = 'running'")
+    print(f"Recovered {len(task_queue)} queued and {len(task_history)} finished tasks.")
+
+def evict_task_history():
+    """Evict finished tasks over the count limit or not read within the TTL."""
+    evicted = []
+    with task_lock:
+        expiry = time.monotonic() - TASK_HISTORY_TTL_SECONDS
+        while task_history:
+            task_id, task = next(iter(task_history.items()))
+            if len(task_history) <= TASK_HISTORY_MAX_TASKS and task["_accessed_at"] > expiry:
+                break
+            task_history.popitem(last=False)
+            task_index.pop(task_id, None)
+            evicted.append(task)
+    archive_tasks(evicted)
+    delete_persisted_tasks([task["task_id"] for task in evicted])
+
+def task_history_evictor():
+    """Evict finished tasks past the TTL even while no task finishes."""
+    while True:
+        time.sleep(TASK_HISTORY_EVICT_INTERVAL_SECONDS)
+        try:
+            evict_task_history()
+        except Exception as e:
+            print(f"Error evicting task history: {e}")
+
+def finish_task(task, status, result=None):
+    """Move a running task to the history with its final status."""
+    with task_lock:
+        task["status"] = status
+        task["result"] = result
+        task["finished_at"] = datetime.utcnow().isoformat()
+        task["position"] = 1
+        running_tasks.pop(task["task_id"], None)
+        task["parameters"] = compact_task_parameters(task["parameters"])
+        task["_accessed_at"] = time.monotonic()
+        task_history[task["task_id"]] = task
+        persist_task(task)
+        task_condition.notify_all()
+    evict_task_history()
+
+def task_lane(type, payload):
+    """Lane of a task, which sets its weight in the fair scheduler."""
+    if payload_image_count(payload) == 1:
+        return "preview"
+    return type
+
+def schedule_task(task):
+    """Tag a pending task for weighted fair queueing and insert it into the pending order.
+
+    Each client's tasks follow one another in virtual time, and a task's finish tag
+    grows with its image count divided by its lane weight. Ordering by finish tag
+    interleaves clients instead of serving one client's backlog first, and lets
+    cheap tasks overtake long inpaints without starving them.
+    """
+    client_id = task.get("_client_id") or "anonymous"
+    start_tag = max(virtual_time, client_finish_tags.get(client_id, 0.0))
+    finish_tag = start_tag + task_image_count(task) / TASK_LANE_WEIGHTS.get(task.get("_lane"), 1)
+    client_finish_tags[client_id] = finish_tag
+    task["_start_tag"] = start_tag
+    task["_schedule_key"] = (finish_tag, task["_ticket"], task["task_id"])
+    bisect.insort(task_queue, task["_schedule_key"])
+
+def unschedule_task(task):
+    """Remove a pending task from the pending order."""
+    index = bisect.bisect_left(task_queue, task["_schedule_key"])
+    if index < len(task_queue) and task_queue[index] == task["_schedule_key"]:
+        del task_queue[index]
+
+def dispatch_next_task():
+    """Take the first task in the fair-scheduled order and advance virtual time."""
+    global virtual_time
+    task = task_index[task_queue.pop(0)[2]]
+    virtual_time = max(virtual_time, task["_start_tag"])
+    if not task_queue:
+        # Every client is idle, so their finish tags no longer matter
+        client_finish_tags.clear()
+    elif len(client_finish_tags) > 1000:
+        for client_id, finish_tag in list(client_finish_tags.items()):
+            if finish_tag <= virtual_time:
+                del client_finish_tags[client_id]
+    return task
+
+def requeue_tasks(tasks):
+    """Put running tasks back in the pending order for another backend."""
+    with task_lock:
+        for task in tasks:
+            task["status"] = "pending"
+            task["_requeued"] = True
+            running_tasks.pop(task["task_id"], None)
+            bisect.insort(task_queue, task["_schedule_key"])
+            persist_task(task)
+        task_condition.notify_all()
+
+def record_backend_result(backend, success):
+    """Track consecutive connection failures and mark the backend unhealthy."""
+    with task_lock:
+        if success:
+            backend["failures"] = 0
+            return
+        backend["failures"] += 1
+        if backend["failures"] >= SD_BACKEND_MAX_FAILURES and backend["healthy"]:
+            print(f"Backend {backend['url']} marked unhealthy.")
+            backend["healthy"] = False
+
+def check_backend_health(backend):
+    """Probe an unhealthy backend and mark it healthy again once it responds."""
+    try:
+        response = sd_session.get(f"{backend['url']}/sdapi/v1/progress", timeout=(SD_CONNECT_TIMEOUT, SD_STATUS_TIMEOUT))
+        if response.status_code == 200:
+            with task_condition:
+                print(f"Backend {backend['url']} is healthy again.")
+                backend["healthy"] = True
+                backend["failures"] = 0
+                task_condition.notify_all()
+    except Exception as e:
+        print(f"Backend {backend['url']} is still unreachable: {e}")
+
+def task_image_count(task):
+    """Number of images a task asks the WebUI to generate."""
+    return payload_image_count(task["parameters"])
+
+def payload_image_count(payload):
+    """Number of images a WebUI payload generates."""
+    try:
+        return max(1, int(payload.get("n_iter") or 1)) * max(1, int(payload.get("batch_size") or 1))
+    except (TypeError, ValueError):
+        return 1
+
+def task_batch_key(type, payload):
+    """Key shared by txt2img tasks that can be generated together in one batch."""
+    if type != "txt2img" or payload.get("alwayson_scripts") or payload.get("batch_size", 1) != 1:
+        return None  # ControlNet appends its detected maps to the images, so those can't be split
+    return json.dumps({key: value for key, value in payload.items() if key != "n_iter"}, sort_keys=True)
+
+def take_batch_companions(task):
+    """Remove the queued tasks right after the task that can share its batch from the queue."""
+    batch_key = task.get("_batch_key")
+    if not batch_key:
+        return []
+    companions = []
+    image_count = task_image_count(task)
+    # Only the unbroken run at the head of the queue joins, so batching never reorders tasks
+    for schedule_key in task_queue:
+        pending_task = task_index[schedule_key[2]]
+        if pending_task.get("_batch_key") != batch_key or image_count + task_image_count(pending_task) > SD_MAX_BATCH_SIZE:
+            break
+        companions.append(pending_task)
+        image_count += task_image_count(pending_task)
+    for companion in companions:
+        unschedule_task(companion)
+    return companions
+
+def batch_parameters(tasks):
+    """Merge the payloads of compatible tasks into one batched WebUI payload."""
+    if len(tasks) == 1:
+        return tasks[0].get("parameters")
+    return {**tasks[0]["parameters"], "n_iter": 1, "batch_size": sum(task_image_count(task) for task in tasks)}
+
+def save_task_results(tasks, images_data):
+    """Save the images of a finished task or batch in parallel and mark its tasks succeeded."""
+    task_ids = ", ".join(task.get("task_id") for task in tasks)
+    try:
+        # Split the batch back into each task's images, in queue order
+        image_counts = [len(images_data)] if len(tasks) == 1 else [task_image_count(task) for task in tasks]
+        offsets = [sum(image_counts[:i]) for i in range(len(tasks))]
+        task_images = [images_data[offset:offset + count] for offset, count in zip(offsets, image_counts)]
+        saved_paths = save_images([image_data for images in task_images for image_data in images if image_data], "images")
+        paths = iter(saved_paths)
+        for task, images in zip(tasks, task_images):
+            image_paths = [next(paths) for image_data in images if image_data]
+            if len(tasks) == 1:
+                finish_task(task, "success", image_paths)
+            else:
+                finish_task(task, "success" if image_paths else "failed", image_paths or None)
+        # Full-size lossy copies and the gallery thumbnails are made once the tasks report success,
+        # while the images are fresh in the page cache; until then the originals are served
+        save_image_variants(saved_paths, RESULT_IMAGE_FORMATS or ["png"], [None] + THUMBNAIL_SIZES)
+    except Exception as e:
+        print(f"Error saving images of task {task_ids}: {e}")
+        for task in tasks:
+            if task.get("status") == "running":
+                finish_task(task, "failed")
+
+def execute_task(tasks, type, backend):
+    """Execute one task or a batch of tasks on a backend with retry logic."""
+    task_ids = ", ".join(task.get("task_id") for task in tasks)
+    parameters = batch_parameters(tasks)
     
     # Attempt to execute the task twice
     for attempt in range(2):  # Retry once (0 and 1)
         try:
-            print(f"Executing task {task_id}.")
-            response = requests.post(f"{SD_URL}/sdapi/v1/{type}", json=task.get("parameters"))
+            print(f"Executing task {task_ids} on {backend['url']}.")
+            response = sd_session.post(f"{backend['url']}/sdapi/v1/{type}", json=parameters, timeout=(SD_CONNECT_TIMEOUT, SD_GENERATION_TIMEOUT))
+            record_backend_result(backend, True)
             print(f"Response: {response.status_code}")
             if response.status_code == 200 and isinstance(response.json(), dict) and response.json().get("images"):
                 # On success
                 images_data = response.json().get("images", [])
                 print(f"Received {len(images_data)} images")
-                image_paths = save_images(images_data, "images")
-                task["status"] = "success"
-                task["result"] = image_paths
-                task["finished_at"] = datetime.utcnow().isoformat()
-                task_history.append(task)
-                task_queue.remove(task)
-                for remaining_task in task_queue:
-                    remaining_task["position"] -= 1
+                # Saving the images is left to the result writers so the backend can start its next task
+                for task in tasks:
+                    task["_saving"] = True
+                result_writer_executor.submit(save_task_results, tasks, images_data)
                 return
             else:
                 # If the first attempt fails
                 if attempt == 0:
-                    print(f"Attempt {attempt + 1} failed for task {task_id}. Retrying...")
+                    print(f"Attempt {attempt + 1} failed for task {task_ids}. Retrying...")
                 else:
                     # On failure (after second attempt)
-                    print(f"Task {task_id} failed after two attempts.")
-                    task["status"] = "failed"
-                    task_history.append(task)
-                    task_queue.remove(task)
-                    for remaining_task in task_queue:
-                        remaining_task["position"] -= 1
+                    print(f"Task {task_ids} failed after two attempts.")
+                    for task in tasks:
+                        finish_task(task, "failed")
                     return
+        except requests.exceptions.ConnectionError as e:
+            print(f"Backend {backend['url']} unreachable for task {task_ids} on attempt {attempt + 1}: {e}")
+            record_backend_result(backend, False)
+            if not backend["healthy"] and not any(task.get("_requeued") for task in tasks) and other_healthy_backend(backend):
+                # Give the tasks to another backend instead of failing them
+                requeue_tasks(tasks)
+                return
+            if attempt == 1:  # Second attempt failed
+                for task in tasks:
+                    finish_task(task, "failed")
         except Exception as e:
-            print(f"Error executing task {task_id} on attempt {attempt + 1}: {e}")
+            print(f"Error executing task {task_ids} on attempt {attempt + 1}: {e}")
             if attempt == 1:  # Second attempt failed
-                task["status"] = "failed"
-                task_history.append(task)
-                task_queue.remove(task)
-                for remaining_task in task_queue:
-                    remaining_task["position"] -= 1
-
-def task_manager():
-    """Manage the task queue and execute tasks based on position changes."""
-    while True:
-        if task_queue:
-            # Only check the task at position 0 with a status of 'pending'
-            for task in task_queue:
-                if task.get("position") == 1 and task.get("status") == "pending":
-                    threading.Thread(target=execute_task, args=(task,task.get("type"))).start()
-                    break  # Only execute one task at a time
-        time.sleep(0.5)  # Shorter sleep to check more frequently
-
-# Start the task manager in a background thread
-threading.Thread(target=task_manager, daemon=True).start()
+                for task in tasks:
+                    finish_task(task, "failed")
+
+def other_healthy_backend(backend):
+    """Check if a backend other than the given one can take tasks."""
+    with task_lock:
+        return any(other is not backend and other["healthy"] for other in sd_backends)
+
+def task_manager(backend):
+    """Wait for queued tasks and execute them one batch at a time on the given backend."""
+    while not backend["stopped"]:
+        if not backend["healthy"]:
+            check_backend_health(backend)
+            if not backend["healthy"] and other_healthy_backend(backend):
+                # Leave the queue to the healthy backends while this one is down
+                time.sleep(SD_BACKEND_RETRY_SECONDS)
+                continue
+        with task_condition:
+            # Sleep until there is a pending task to dispatch
+            while not task_queue and not backend["stopped"]:
+                task_condition.wait()
+            if backend["stopped"]:
+                return
+            if not backend["healthy"] and other_healthy_backend(backend):
+                continue
+            task = dispatch_next_task()
+            tasks = [task] + take_batch_companions(task)
+            for task in tasks:
+                task["status"] = "running"
+                task["_backend"] = backend
+                running_tasks[task["task_id"]] = task
+                persist_task(task)
+            backend["busy"] = True
+        try:
+            execute_task(tasks, tasks[0].get("type"), backend)
+        except Exception as e:
+            print(f"Error in task manager: {e}")
+        with task_lock:
+            backend["busy"] = False
+            # Never leave a task stuck in the running state on this backend
+            for task in tasks:
+                if task.get("status") == "running" and task.get("_backend") is backend and not task.get("_saving"):
+                    finish_task(task, "failed")
+
+def start_task_worker(url):
+    """Add a backend and start its long-lived worker thread."""
+    backend = {"url": url, "busy": False, "healthy": True, "failures": 0, "stopped": False}
+    with task_lock:
+        sd_backends.append(backend)
+    threading.Thread(target=task_manager, args=(backend,), daemon=True).start()
+    return backend
+
+def stop_task_worker(backend):
+    """Remove a backend, its worker exits once its current batch is done."""
+    with task_condition:
+        # Backends with the same URL compare equal, so remove this one by identity
+        backend["stopped"] = True
+        sd_backends[:] = [other for other in sd_backends if other is not backend]
+        task_condition.notify_all()
+
+def select_backend_url():
+    """Pick a backend for direct calls, preferring healthy idle ones."""
+    with task_lock:
+        healthy = [backend for backend in sd_backends if backend["healthy"]]
+        idle = [backend for backend in healthy if not backend["busy"]]
+        if not sd_backends:
+            return SD_URL
+        backend = (idle or healthy or sd_backends)[0]
+        return backend["url"]
+
+def task_backend_url(task_id):
+    """Get the URL of the backend a task was dispatched to."""
+    with task_lock:
+        task = task_index.get(task_id)
+        if task and task.get("_backend"):
+            return task["_backend"]["url"]
+    return select_backend_url()
+
+# Recover queued tasks from the task database before starting the workers
+if TASK_DATABASE_FILE:
+    recover_tasks()
+
+# Start one long-lived worker thread per backend
+for url in SD_URLS:
+    start_task_worker(url)
+threading.Thread(target=task_history_evictor, daemon=True).start()
 
 # QUEUEING, STATUS & PROGRESS TRACKING
-def queue_task(payload, type):
+def get_client_id():
+    """Identify the client of the current request for fair scheduling."""
+    forwarded_for = request.headers.get("X-Forwarded-For", "").split(",")[0].strip()
+    return (request.form.get("client_id") or request.headers.get("X-Client-Id")
+            or request.headers.get("CF-Connecting-IP") or forwarded_for or request.remote_addr or "anonymous")
+
+def queue_task(payload, type, client_id=None):
+    global next_ticket
     try:
         task_id = str(uuid.uuid4())
         queued_at = datetime.utcnow().isoformat()
-        task = {
-            "task_id": task_id,
-            "status": "pending",
-            "position": len(task_queue) + 1,
-            "type": type,
-            "parameters": payload,
-            "queued_at": queued_at,
-            "finished_at": None,
-            "result": None
-        }
-        task_queue.append(task)
-        return task
+        with task_lock:
+            task = {
+                "task_id": task_id,
+                "status": "pending",
+                "position": None,
+                "type": type,
+                "parameters": payload,
+                "queued_at": queued_at,
+                "finished_at": None,
+                "result": None,
+                "_ticket": next_ticket,
+                "_client_id": client_id,
+                "_lane": task_lane(type, payload),
+                "_batch_key": task_batch_key(type, payload)
+            }
+            next_ticket += 1
+            task_index[task_id] = task
+            schedule_task(task)
+            persist_task(task)
+            # Every worker wakes, as one whose backend is down leaves the task to the others
+            task_condition.notify_all()
+            return task_snapshot(task)
     except Exception as e:
         print(f"Error queueing task: {e}")
         return None
@@ -373,18 +1143,18 @@ def queue_task(payload, type):
 def get_task_queue_status(task_id):
     """Check the status of a specific task."""
     try:
-        # Check task queue first
-        for task in task_queue:
-            if task.get("task_id") == task_id:
-                return task
-
-        # Check task history if not found in queue
-        for task in task_history:
-            if task.get("task_id") == task_id:
-                return task
-
-        # Return None if not found in both
-        return None
+        # Look up the task in the index and return a snapshot of it
+        with task_lock:
+            task = task_index.get(task_id)
+            if task and task_id in task_history:
+                # Reading a finished task keeps it in memory for longer
+                task["_accessed_at"] = time.monotonic()
+                task_history.move_to_end(task_id)
+            if task:
+                return task_snapshot(task)
+
+        # Fall back to the archive for tasks evicted from memory
+        return find_archived_task(task_id)
     except Exception as e:
         print(f"Error fetching task status for {task_id}: {e}")
         return None
@@ -418,7 +1188,7 @@ def track_image_generation_progress():
             return jsonify({"error": "Task not found"}), 404
 
         # Request progress API using GET
-        response = requests.get(f"{SD_URL}/sdapi/v1/progress?skip_current_image=false")
+        response = sd_session.get(f"{task_backend_url(task_id)}/sdapi/v1/progress?skip_current_image=false", timeout=(SD_CONNECT_TIMEOUT, SD_STATUS_TIMEOUT))
 
         if response.status_code == 200:
             progress_data = response.json()
@@ -436,15 +1206,15 @@ def track_image_generation_progress():
 def get_task_results(task_id):
     """Retrieve the results of a completed task from the scheduler"""
     try:
-        for task in task_history + task_queue:
-            if task.get("task_id") == task_id:
-                if task.get("status") == "success" and task.get("result"):
-                    image_paths = task.get("result", [])
-                    return jsonify({"message": "Images retrieved.", "image_paths": image_paths}), 200
-                elif task.get("status") == "failed":
-                    return jsonify({"error": "No images were generated."}), 500
-                else:
-                    return jsonify({"message": f"Task is {task.get('status')} at {task.get('position')}.", "task": task}), 202
+        task = get_task_queue_status(task_id)
+        if task:
+            if task.get("status") == "success" and task.get("result"):
+                image_paths = task.get("result", [])
+                return jsonify({"message": "Images retrieved.", "image_paths": image_paths}), 200
+            elif task.get("status") == "failed":
+                return jsonify({"error": "No images were generated."}), 500
+            else:
+                return jsonify({"message": f"Task is {task.get('status')} at {task.get('position')}.", "task": task}), 202
         return jsonify({"error": "Task not found."}), 404
     except Exception as e:
         print(f"Error fetching task results: {e}")
@@ -462,6 +1232,79 @@ def get_task_results_route():
         print(f"Error getting task results: {e}")
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
+# CONTROLNET PREPROCESSING
+def resize_with_pad(image_np, resolution):
+    """Resize so the short side matches the resolution, keeping the aspect ratio, and edge-pad to multiples of 64.
+
+    Returns the padded image and the size to crop the preprocessed map back to, like ControlNet 1.1 does.
+    """
+    height, width = image_np.shape[:2]
+    k = float(resolution) / min(height, width)
+    new_height, new_width = int(np.round(height * k)), int(np.round(width * k))
+    interpolation = cv2.INTER_CUBIC if k > 1 else cv2.INTER_AREA
+    image_np = cv2.resize(image_np, (new_width, new_height), interpolation=interpolation)
+    pad_height, pad_width = -new_height % 64, -new_width % 64
+    padded = np.pad(image_np, [[0, pad_height], [0, pad_width], [0, 0]], mode='edge')
+    return padded, (new_height, new_width)
+
+def preprocess_canny(image_np, resolution, low_threshold=100, high_threshold=200):
+    """ControlNet "canny" preprocessor: edges of the resized image."""
+    # ControlNet runs Canny on RGB, and ties between channels make the order matter
+    padded, (height, width) = resize_with_pad(cv2.cvtColor(image_np, cv2.COLOR_BGR2RGB), resolution)
+    edges = cv2.Canny(padded, low_threshold, high_threshold)[:height, :width]
+    return cv2.cvtColor(edges, cv2.COLOR_GRAY2BGR)
+
+def preprocess_color_grid(image_np, resolution):
+    """ControlNet "t2ia_color_grid" preprocessor: 64x downsampled colors blown back up."""
+    padded, (height, width) = resize_with_pad(image_np, resolution)
+    padded_height, padded_width = padded.shape[:2]
+    grid = cv2.resize(padded, (padded_width // 64, padded_height // 64), interpolation=cv2.INTER_CUBIC)
+    return cv2.resize(grid, (padded_width, padded_height), interpolation=cv2.INTER_NEAREST)[:height, :width]
+
+CONTROLNET_PREPROCESSORS = {
+    "canny": preprocess_canny,
+    "t2ia_color_grid": preprocess_color_grid,
+}
+
+def preprocess_controlnet_image(image_base64, module, target_width, target_height):
+    """Run a ControlNet preprocessor locally, caching the map by image hash."""
+    # Hashing the encoded image is much cheaper than decoding it again on a cache hit
+    image_hash = hashlib.blake2b(image_base64.encode(), digest_size=20).hexdigest()
+    cache_key = (module, target_width, target_height, image_hash)
+    with controlnet_cache_lock:
+        if cache_key in controlnet_cache:
+            controlnet_cache.move_to_end(cache_key)
+            return controlnet_cache[cache_key]
+
+    image_np = cv2.imdecode(np.frombuffer(base64.b64decode(extract_base64_data(image_base64)), np.uint8), cv2.IMREAD_COLOR)
+    if image_np is None:
+        return None
+    # Pixel perfect resolution for "Scale to Fit (Inner Fit)"
+    height, width = image_np.shape[:2]
+    resolution = int(round(min(target_height / height, target_width / width) * min(height, width)))
+    preprocessed = encode_png_base64(CONTROLNET_PREPROCESSORS[module](image_np, resolution))
+
+    with controlnet_cache_lock:
+        controlnet_cache[cache_key] = preprocessed
+        while len(controlnet_cache) > CONTROLNET_CACHE_MAX_ENTRIES:
+            controlnet_cache.popitem(last=False)
+    return preprocessed
+
+def preprocess_controlnet_args(payload):
+    """Replace ControlNet images in a payload with locally preprocessed maps."""
+    if not CONTROLNET_LOCAL_PREPROCESSING:
+        return payload
+    for arg in payload.get("alwayson_scripts", {}).get("controlnet", {}).get("args", []):
+        if arg.get("module") in CONTROLNET_PREPROCESSORS and arg.get("image"):
+            try:
+                preprocessed = preprocess_controlnet_image(arg["image"], arg["module"], payload.get("width", 512), payload.get("height", 512))
+                if preprocessed:
+                    arg["image"] = preprocessed
+                    arg["module"] = "none"
+            except Exception as e:
+                print(f"Error preprocessing ControlNet image locally, leaving it to the WebUI: {e}")
+    return payload
+
 # FIRST IMAGE GENERATION
 def validate_first_generation_request(data):
     """Validate the first image generation request."""
@@ -477,6 +1320,8 @@ def validate_first_generation_request(data):
             # Color palette
             color_palette_str = data.get('color_palette', '[]')
             color_palette = json.loads(color_palette_str) if color_palette_str else []
+            # Style
+            style = data.get('style') or SDXL_DEFAULT_STYLE
             # Base image
             base_image = request.files.get('base_image')
             if base_image and allowed_file(base_image.filename):
@@ -499,6 +1344,7 @@ def validate_first_generation_request(data):
             prompt = data.get('prompt', "").strip()
             number_of_images = data.get("number_of_images", 0)
             color_palette = data.get('color_palette', [])
+            style = data.get('style') or SDXL_DEFAULT_STYLE
             base_image_encoded = None
             style_reference_encoded = None
         
@@ -507,12 +1353,18 @@ def validate_first_generation_request(data):
         print(f"Prompt: {prompt}")
         print(f"Number of Images: {number_of_images}")
         print(f"Color Palette: {color_palette}")
+        print(f"Style: {style}")
         
         if not prompt:
             print("Empty prompt")
             return None, None, None, None, "Prompt is required"
+
+        # Without a loaded registry every style falls back to the plain prompt
+        if sdxl_styles and style not in sdxl_styles:
+            print(f"Unknown SDXL style: {style}")
+            return None, None, None, None, f"Unknown style: {style}"
         
-        prompt, negative_prompt = apply_sdxl_style("3D Model", prompt, color_palette)
+        prompt, negative_prompt = apply_sdxl_style(style, prompt, color_palette)
         print("========Final Prompt========")
         print(f"Prompt: {prompt}")
         print(f"Negative Prompt: {negative_prompt}")
@@ -531,8 +1383,8 @@ def generate_first_image(prompt, negative_prompt, number_of_images, base_image,
             "sampler_name": "DPM++ 2M SDE",
             "steps": 30,
             "cfg_scale": 6,
-            "width": 512,
-            "height": 512,
+            "width": SD_GENERATION_WIDTH,
+            "height": SD_GENERATION_HEIGHT,
             "n_iter": number_of_images,
             "seed": -1,
             "denoising_strength": 0.3,
@@ -616,7 +1468,7 @@ def generate_first_image(prompt, negative_prompt, number_of_images, base_image,
         # return response
 
         # Queue the task for image generation
-        task = queue_task(payload, "txt2img")
+        task = queue_task(preprocess_controlnet_args(payload), "txt2img", get_client_id())
         if task:
             return jsonify(task=task), 200
         else:
@@ -635,7 +1487,8 @@ def generate_first_image_route():
         prompt, negative_prompt, number_of_images, base_image_encoded, style_reference_encoded = validate_first_generation_request(data)
         
         if not prompt:
-            return jsonify({"error": "Prompt is required"}), 400
+            # When validation fails, the last value holds the error message
+            return jsonify({"error": style_reference_encoded or "Prompt is required"}), 400
 
         # Call the image generation function
         response, status_code = generate_first_image(prompt, negative_prompt, number_of_images, base_image_encoded, style_reference_encoded)
@@ -671,6 +1524,55 @@ def generate_first_image_route():
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
 # GENERATE SAM MASK
+@functools.lru_cache(maxsize=8)
+def sam_dilation_kernel(dilate_amount):
+    """Disk kernel used by the SAM extension, flipped for cv2.dilate along with its anchor."""
+    x, y = np.meshgrid(np.arange(dilate_amount), np.arange(dilate_amount))
+    center = dilate_amount // 2
+    kernel = ((x - center) ** 2 + (y - center) ** 2 <= center ** 2).astype(np.uint8)
+    # scipy's binary_dilation reflects the kernel about its center; cv2.dilate does not
+    anchor = dilate_amount - 1 - center
+    return kernel[::-1, ::-1].copy(), (anchor, anchor)
+
+def encode_png_base64(image_np):
+    """Encode a NumPy image to a base64 PNG string."""
+    _, buffer = cv2.imencode('.png', image_np)
+    return base64.b64encode(buffer).decode('utf-8')
+
+def dilate_sam_masks(init_image, masks, dilate_amount):
+    """Dilate SAM masks locally, producing the blended image, mask and masked image of /sam/dilate-mask."""
+    image_bgra = cv2.imdecode(np.frombuffer(base64.b64decode(extract_base64_data(init_image)), np.uint8), cv2.IMREAD_UNCHANGED)
+    if image_bgra.ndim == 2:
+        image_bgra = cv2.cvtColor(image_bgra, cv2.COLOR_GRAY2BGRA)
+    elif image_bgra.shape[2] == 3:
+        image_bgra = cv2.cvtColor(image_bgra, cv2.COLOR_BGR2BGRA)
+    height, width = image_bgra.shape[:2]
+    blend_color = np.array(SAM_BLEND_COLOR, dtype=np.float32)[[2, 1, 0, 3]] * 255 * 0.5
+
+    reply_dilate = {"blended_images": [], "masks": [], "masked_images": []}
+    for mask_base64 in masks:
+        mask = decode_base64_image(extract_base64_data(mask_base64))
+        if mask.shape != (height, width):
+            mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+        binary_mask = (mask >= 128).astype(np.uint8)
+        if dilate_amount:
+            kernel, anchor = sam_dilation_kernel(dilate_amount)
+            binary_mask = cv2.dilate(binary_mask, kernel, anchor=anchor)
+        selected = binary_mask.astype(bool)
+
+        # Half-transparent color overlay on the masked area
+        blended_image = image_bgra.copy()
+        blended_image[selected] = (blended_image[selected] * 0.5 + blend_color).astype(np.uint8)
+
+        # Original pixels inside the mask, transparent black outside
+        masked_image = image_bgra.copy()
+        masked_image[~selected] = 0
+
+        reply_dilate["blended_images"].append(encode_png_base64(blended_image))
+        reply_dilate["masks"].append(encode_png_base64(binary_mask * 255))
+        reply_dilate["masked_images"].append(encode_png_base64(masked_image))
+    return reply_dilate
+
 def generate_sam_mask(init_image, mask_prompt):
     """Generate SAM mask based on an image and text prompt."""
     if not mask_prompt:
@@ -681,19 +1583,20 @@ def generate_sam_mask(init_image, mask_prompt):
         try:
             # Prepare SAM request payload
             payload = {
-                "sam_model_name": "sam_vit_b_01ec64.pth",
+                "sam_model_name": SAM_MODEL_NAME,
                 "input_image": init_image,
                 "sam_positive_points": [],
                 "sam_negative_points": [],
                 "dino_enabled": True,
-                "dino_model_name": "GroundingDINO_SwinT_OGC (694MB)",
+                "dino_model_name": DINO_MODEL_NAME,
                 "dino_text_prompt": mask_prompt,
-                "dino_box_threshold": 0.3,
+                "dino_box_threshold": DINO_BOX_THRESHOLD,
                 "dino_preview_checkbox": False,
             }
 
             # Call SAM API to generate the mask
-            response = requests.post(f"{SD_URL}/sam/sam-predict", json=payload)
+            sd_url = select_backend_url()
+            response = sd_session.post(f"{sd_url}/sam/sam-predict", json=payload, timeout=(SD_CONNECT_TIMEOUT, SD_SAM_TIMEOUT))
             if response.status_code != 200:
                 if attempt == 0:  # If the first attempt fails
                     print(f"Attempt {attempt + 1} failed with status code: {response.status_code}. Retrying...")
@@ -711,16 +1614,22 @@ def generate_sam_mask(init_image, mask_prompt):
                 return None, 400
 
             try:
+                if SAM_LOCAL_DILATION:
+                    # Dilate up to 3 masks in-process, without sending the image back to the WebUI
+                    return dilate_sam_masks(init_image, masks[:3], SAM_DILATE_AMOUNT)
+
                 # Dilate the masks and collect responses
                 dilate_payloads = [
-                    {"input_image": init_image, "mask": masks[i], "dilate_amount": 10}
+                    {"input_image": init_image, "mask": masks[i], "dilate_amount": SAM_DILATE_AMOUNT}
                     for i in range(min(3, len(masks)))  # Ensure we process up to 3 masks
                 ]
 
-                replies_dilate = []
-                for payload in dilate_payloads:
-                    dilate_response = requests.post(f"{SD_URL}/sam/dilate-mask", json=payload)
-                    replies_dilate.append(dilate_response.json())
+                # Send the dilation requests concurrently, keeping the replies in mask order
+                def dilate_mask(payload):
+                    dilate_response = sd_session.post(f"{sd_url}/sam/dilate-mask", json=payload, timeout=(SD_CONNECT_TIMEOUT, SD_SAM_TIMEOUT))
+                    return dilate_response.json()
+
+                replies_dilate = list(sd_request_executor.map(dilate_mask, dilate_payloads))
 
                 # Extract blended images, masks, and masked images
                 reply_dilate = {
@@ -733,7 +1642,7 @@ def generate_sam_mask(init_image, mask_prompt):
             except Exception as e:
                 print(f"Error expanding SAM mask: {e}")
                 print("Returning original SAM mask instead.")
-                return reply_json
+                return {**reply_json, "dilated": False}
 
         except Exception as e:
             print(f"Error generating SAM mask: {e}")
@@ -742,6 +1651,36 @@ def generate_sam_mask(init_image, mask_prompt):
                 continue  # Retry
             return {"error": f"An error occurred: {str(e)}"}, 500
 
+def sam_cache_key(init_image, mask_prompt):
+    """Cache key of a SAM mask request: image pixels, prompt and every SAM setting."""
+    pixel_hash = image_pixel_hash(init_image)
+    if pixel_hash is None:
+        return None
+    # GroundingDINO lowercases its text prompt, so case doesn't change the masks
+    return json.dumps([pixel_hash, mask_prompt.strip().lower(), SAM_MODEL_NAME, DINO_MODEL_NAME, DINO_BOX_THRESHOLD, SAM_DILATE_AMOUNT])
+
+def get_cached_sam_mask(cache_key):
+    """Return cached SAM mask paths for a key, if all of their files still exist."""
+    with sam_cache_lock:
+        image_paths = sam_cache.get(cache_key) if cache_key else None
+        if image_paths and all(os.path.exists(path.lstrip('/')) for paths in image_paths.values() for path in paths):
+            sam_cache.move_to_end(cache_key)
+            sam_cache_stats["hits"] += 1
+            return image_paths
+        sam_cache.pop(cache_key, None)
+        sam_cache_stats["misses"] += 1
+        return None
+
+def cache_sam_mask(cache_key, image_paths):
+    """Store SAM mask paths, evicting the least recently used entries over the limit."""
+    if not cache_key:
+        return
+    with sam_cache_lock:
+        sam_cache[cache_key] = image_paths
+        sam_cache.move_to_end(cache_key)
+        while len(sam_cache) > SAM_CACHE_MAX_ENTRIES:
+            sam_cache.popitem(last=False)
+
 @app.route('/generate-sam-mask', methods=['POST'])
 def generate_sam_mask_route():
     """Route to generate SAM mask."""
@@ -770,6 +1709,13 @@ def generate_sam_mask_route():
         else:
             return jsonify({"error": "Invalid base image"}), 400
 
+        # Return the masks of an earlier identical request if they are cached
+        cache_key = sam_cache_key(init_image_encoded, mask_prompt)
+        image_paths = get_cached_sam_mask(cache_key)
+        if image_paths:
+            print("SAM mask cache hit.")
+            return jsonify({"image_paths": image_paths}), 200
+
         # Call generate SAM mask function
         response = generate_sam_mask(init_image_encoded, mask_prompt)
 
@@ -781,6 +1727,10 @@ def generate_sam_mask_route():
                 "masks": save_images(response.get("masks"), "masks"),
                 "masked_images": save_images(response.get("masked_images"), "masks"),
             }
+            save_image_variants(image_paths["masks"], ["1bit"])
+            # Undilated fallback masks are not cached, so the next request tries dilating them again
+            if response.get("dilated", True):
+                cache_sam_mask(cache_key, image_paths)
             return jsonify({"image_paths": image_paths}), 200
         else:
             return jsonify({"error": "Failed to generate SAM mask. Incomplete response."}), 500
@@ -871,201 +1821,101 @@ def validate_preview_mask(data):
         print(f"Validation error: {e}")
         return None, None, None, None, f"Validation error: {str(e)}", 400
 
-def combine_masks(sam_mask_input, user_mask_base64):
-    # Check if sam_mask_input is a valid URL or file path
-    if sam_mask_input and validators.url(sam_mask_input):
+def load_mask(mask_input):
+    """Load a mask from a URL, file path or base64 string as a grayscale NumPy array."""
+    if mask_input and validators.url(mask_input):
         try:
             # Fetch the image from the URL
-            response = requests.get(sam_mask_input, timeout=10)
+            response = requests.get(mask_input, timeout=10)
             response.raise_for_status()
-            sam_mask = cv2.imdecode(np.frombuffer(response.content, np.uint8), cv2.IMREAD_GRAYSCALE)
+            return cv2.imdecode(np.frombuffer(response.content, np.uint8), cv2.IMREAD_GRAYSCALE)
         except Exception as e:
             print(f"Error fetching SAM mask from URL: {e}")
-            return None, f"Error fetching SAM mask from URL: {e}", 400
-    elif sam_mask_input and os.path.exists(sam_mask_input):
+            return None
+    elif mask_input and os.path.exists(mask_input):
         # Load SAM mask from file path
-        sam_mask = cv2.imread(sam_mask_input, cv2.IMREAD_GRAYSCALE)
+        return cv2.imread(mask_input, cv2.IMREAD_GRAYSCALE)
     else:
         # Decode SAM mask from base64
         print("SAM mask path doesn't exist; trying to decode base64.")
-        sam_mask = decode_base64_image(sam_mask_input)
-    
-    if sam_mask is None:
-        print("Error: SAM mask could not be loaded or decoded.")
-        return None
-
-    # Convert SAM mask to binary (black and white only)
-    _, sam_mask = cv2.threshold(sam_mask, 127, 255, cv2.THRESH_BINARY)
+        return decode_base64_image(mask_input)
 
-    # Check if user_mask_base64 is provided
+def load_user_mask(user_mask_base64, shape):
+    """Decode a user-drawn mask as a binary mask matching the SAM mask shape, or None if it is empty."""
     if not user_mask_base64:
-        print("No user mask provided; returning SAM mask only.")
-        if validators.url(sam_mask_input):
-            return sam_mask_input, None, None
-        elif os.path.exists(sam_mask_input):
-            return sam_mask_input, None, None
-        else:
-            return save_image_from_base64(sam_mask_input, "masks"), None, None
-
-    # Decode user mask from base64
-    user_mask = decode_base64_image(user_mask_base64)
-    
-    # Check if user_mask is valid
-    if user_mask is None or np.count_nonzero(user_mask) == 0:
-        print("User mask is all black or invalid; returning SAM mask.")
-        if validators.url(sam_mask_input):
-            return sam_mask_input, None, None
-        elif os.path.exists(sam_mask_input):
-            return sam_mask_input, None, None
-        else:
-            return save_image_from_base64(sam_mask_input, "masks"), None, None
-        
-    # Resize user mask to match SAM mask dimensions
-    user_mask = cv2.resize(user_mask, (sam_mask.shape[1], sam_mask.shape[0]))
-
-    # Convert user mask to binary (black and white only)
-    _, user_mask = cv2.threshold(user_mask, 127, 255, cv2.THRESH_BINARY)
-
-    # Combine the masks
-    combined_mask = cv2.addWeighted(sam_mask, 1, user_mask, 1, 0)
-
-    # Threshold the combined mask to ensure it’s binary (0 and 255)
-    _, combined_mask = cv2.threshold(combined_mask, 1, 255, cv2.THRESH_BINARY)
-
-    if combined_mask is None:
-        print("Failed to create the combined mask.")
-        return None, "Failed to create the combined mask.", 500
-
-    # Save combined mask to a temporary buffer
-    _, combined_mask_buffer = cv2.imencode('.png', combined_mask)
-    combined_mask_base64 = base64.b64encode(combined_mask_buffer).decode('utf-8')
-
-    # Save and return the combined mask path
-    combined_mask_path = save_image_from_base64(combined_mask_base64, "masks")
-    print(f"Combined Mask Path: {combined_mask_path}")
-
-    return combined_mask_path, None, None
-
-def subtract_masks(sam_mask_input, user_mask_base64):
-    # Check if sam_mask_input is a valid URL or file path
-    if sam_mask_input and validators.url(sam_mask_input):
-        try:
-            # Fetch the image from the URL
-            response = requests.get(sam_mask_input, timeout=10)
-            response.raise_for_status()
-            sam_mask = cv2.imdecode(np.frombuffer(response.content, np.uint8), cv2.IMREAD_GRAYSCALE)
-        except Exception as e:
-            print(f"Error fetching SAM mask from URL: {e}")
-            return None, f"Error fetching SAM mask from URL: {e}", 400
-    elif sam_mask_input and os.path.exists(sam_mask_input):
-        # Load SAM mask from file path
-        sam_mask = cv2.imread(sam_mask_input, cv2.IMREAD_GRAYSCALE)
-    else:
-        # Decode SAM mask from base64
-        print("SAM mask path doesn't exist; trying to decode base64.")
-        sam_mask = decode_base64_image(sam_mask_input)
-        
-    if sam_mask is None:
-        print("Error: SAM mask could not be loaded or decoded.")
+        print("No user mask provided.")
         return None
 
-    # Convert SAM mask to binary (black and white only)
-    _, sam_mask = cv2.threshold(sam_mask, 127, 255, cv2.THRESH_BINARY)
-
-    # Check if user_mask_base64 is provided
-    if not user_mask_base64:
-        print("No user mask provided; returning SAM mask only.")
-        if validators.url(sam_mask_input):
-            return sam_mask_input, None, None
-        elif os.path.exists(sam_mask_input):
-            return sam_mask_input, None, None
-        else:
-            return save_image_from_base64(sam_mask_input, "masks"), None, None
-
-    # Decode user mask from base64
     user_mask = decode_base64_image(user_mask_base64)
-    
-    # Check if user_mask is valid and return path
     if user_mask is None or np.count_nonzero(user_mask) == 0:
-        print("User mask is all black or invalid; returning SAM mask.")
-        if validators.url(sam_mask_input):
-            return sam_mask_input, None, None
-        elif os.path.exists(sam_mask_input):
-            return sam_mask_input, None, None
-        else:
-            return save_image_from_base64(sam_mask_input, "masks"), None, None
-
-    # Resize user mask to match SAM mask dimensions
-    user_mask = cv2.resize(user_mask, (sam_mask.shape[1], sam_mask.shape[0]))
+        print("User mask is all black or invalid; ignoring it.")
+        return None
 
-    # Convert user mask to binary (black and white only)
+    # Resize user mask to match SAM mask dimensions and convert it to binary (black and white only)
+    user_mask = cv2.resize(user_mask, (shape[1], shape[0]))
     _, user_mask = cv2.threshold(user_mask, 127, 255, cv2.THRESH_BINARY)
-
-    # Subtract user mask from SAM mask (white parts removed from SAM mask)
-    subtracted_mask = cv2.subtract(sam_mask, user_mask)
-
-    if subtracted_mask is None:
-        print("Failed to create the subtracted mask.")
-        return None, "Failed to create the subtracted mask.", 500
-
-    # Threshold the subtracted mask to ensure it’s binary (0 and 255)
-    _, subtracted_mask = cv2.threshold(subtracted_mask, 1, 255, cv2.THRESH_BINARY)
-
-    # Save subtracted mask to a temporary buffer
-    _, subtracted_mask_buffer = cv2.imencode('.png', subtracted_mask)
-    subtracted_mask_base64 = base64.b64encode(subtracted_mask_buffer).decode('utf-8')
-
-    # Save and return the subtracted mask path
-    subtracted_mask_path = save_image_from_base64(subtracted_mask_base64, "masks")
-    print(f"Subtracted Mask Path: {subtracted_mask_path}")
-
-    return subtracted_mask_path, None, None
+    return user_mask
+
+def compose_masks(sam_mask, user_mask_add=None, user_mask_remove=None, refine_option=0):
+    """Compose binary (0/255) masks with in-place bitwise operations.
+
+    refine_option 0 adds then removes: (sam | add) & ~remove.
+    refine_option 1 removes then adds: (sam & ~remove) | add.
+    Missing user masks are skipped.
+    """
+    composed_mask = sam_mask.copy()
+    if refine_option == 0 and user_mask_add is not None:
+        cv2.bitwise_or(composed_mask, user_mask_add, dst=composed_mask)
+    if user_mask_remove is not None:
+        cv2.bitwise_and(composed_mask, cv2.bitwise_not(user_mask_remove), dst=composed_mask)
+    if refine_option == 1 and user_mask_add is not None:
+        cv2.bitwise_or(composed_mask, user_mask_add, dst=composed_mask)
+    return composed_mask
+
+def make_black_transparent(mask):
+    """Turn a binary mask into a white RGBA image that is transparent where the mask is black."""
+    transparent_mask = np.full((*mask.shape, 4), 255, dtype=np.uint8)
+    transparent_mask[:, :, 3] = mask
+    return transparent_mask
+
+def save_image_array(image_np, folder_name):
+    """Encode a NumPy image as PNG straight to disk and return its path."""
+    filename = generate_image_filename("png")
+    folder_path = f"static/{folder_name}"
+    os.makedirs(folder_path, exist_ok=True)
+    image_path = os.path.join(folder_path, filename)
+    cv2.imwrite(image_path, image_np)
+    print(f"Image saved at: {image_path}")
+    return f"/static/{folder_name}/{filename}"
 
 def preview_mask(refine_option, sam_mask, user_mask_add, user_mask_remove):
     """Combining preview mask logic."""
     try:
-        if refine_option == 0:  # Add then remove
-            combined_1, error_message, error_status = combine_masks(sam_mask, user_mask_add)
-            if combined_1 and validators.url(combined_1):
-                print(f"Combined Mask is SAM URL: {combined_1}")
-                combined_1_updated = combined_1
-            else:
-                combined_1_updated = image_path_to_base64(combined_1)
-            combined_2, error_message, error_status = subtract_masks(combined_1_updated, user_mask_remove)
-            if combined_2 is None:
-                print("Error: combined_2 is None.")
-                return {"error_message": error_message, "error_status": error_status}
-
-            # Convert combined_2 to have transparency for black parts
-            print("combined_2", combined_2)
-            combined_2_png = make_black_transparent(combined_2)
-            if combined_2_png:
-                print(f"Modified image saved at: {combined_2_png}")
-
-            return { "mask": combined_2, "masked_image": combined_2_png }
-        
-        elif refine_option == 1:  # Remove then add
-            combined_1, error_message, error_status = subtract_masks(sam_mask, user_mask_remove)
-            if combined_1 and validators.url(combined_1):
-                print(f"Combined Mask is SAM URL: {combined_1}")
-                combined_1_updated = combined_1
-            else:
-                combined_1_updated = image_path_to_base64(combined_1)
-            combined_2, error_message, error_status = combine_masks(combined_1_updated, user_mask_add)
-            if combined_2 is None:
-                print("Error: combined_2 is None.")
-                return {"error_message": error_message, "error_status": error_status}
-            
-            # Convert combined_2 to have transparency for black parts
-            combined_2_png = make_black_transparent(combined_2)
-
-            return { "mask": combined_2, "masked_image": combined_2_png }
-        
-        return {"error_message": "Error combining masks for preview", "error_status": 500}
+        if refine_option not in (0, 1):
+            return {"error_message": "Error combining masks for preview", "error_status": 500}
+
+        # Load every mask once and keep them in memory until the final outputs are saved
+        sam_mask = load_mask(sam_mask)
+        if sam_mask is None:
+            print("Error: SAM mask could not be loaded or decoded.")
+            return {"error_message": "SAM mask could not be loaded or decoded.", "error_status": 400}
+        # Convert SAM mask to binary (black and white only)
+        _, sam_mask = cv2.threshold(sam_mask, 127, 255, cv2.THRESH_BINARY)
+        user_mask_add = load_user_mask(user_mask_add, sam_mask.shape)
+        user_mask_remove = load_user_mask(user_mask_remove, sam_mask.shape)
+
+        # Add then remove (0) or remove then add (1)
+        combined_mask = compose_masks(sam_mask, user_mask_add, user_mask_remove, refine_option)
+
+        # Save the mask and a copy with transparency for black parts
+        mask_path = save_image_array(combined_mask, "masks")
+        masked_image_path = save_image_array(make_black_transparent(combined_mask), "masks")
+        save_image_variants([mask_path], ["1bit"])
+        return { "mask": mask_path, "masked_image": masked_image_path }
     
     except Exception as e:
         print(f"Error combining masks for preview: {e}")
-        return {"error_message": error_message, "error_status": error_status}
+        return {"error_message": f"Error combining masks for preview: {str(e)}", "error_status": 500}
 
 @app.route('/preview-mask', methods=['POST'])
 def preview_mask_route():
@@ -1113,6 +1963,8 @@ def validate_next_generation_request(data):
             # Color palette
             color_palette_str = data.get('color_palette', '[]')
             color_palette = json.loads(color_palette_str) if color_palette_str else []
+            # Style
+            style = data.get('style') or SDXL_DEFAULT_STYLE
             # Init image
             init_image = request.files.get('init_image') or request.form.get('init_image')
             if init_image:
@@ -1159,6 +2011,7 @@ def validate_next_generation_request(data):
             negative_prompt = ""
             number_of_images = data.get("number_of_images", 0)
             color_palette = data.get('color_palette', [])
+            style = data.get('style') or SDXL_DEFAULT_STYLE
             init_image_encoded = None
             combined_mask_encoded = None
             style_reference_encoded = None
@@ -1168,12 +2021,18 @@ def validate_next_generation_request(data):
         print(f"Prompt: {prompt}")
         print(f"Number of Images: {number_of_images}")
         print(f"Color Palette: {color_palette}")
+        print(f"Style: {style}")
 
         if not prompt:
             print("Empty prompt")
             return None, None, None, None, None, None, "Prompt is required", 400
+
+        # Without a loaded registry every style falls back to the plain prompt
+        if sdxl_styles and style not in sdxl_styles:
+            print(f"Unknown SDXL style: {style}")
+            return None, None, None, None, None, None, f"Unknown style: {style}", 400
         
-        prompt, negative_prompt = apply_sdxl_style("3D Model", prompt, color_palette)
+        prompt, negative_prompt = apply_sdxl_style(style, prompt, color_palette)
         print("========Final Prompt========")
         print(f"Prompt: {prompt}")
         print(f"Negative Prompt: {negative_prompt}")
@@ -1193,8 +2052,8 @@ def generate_next_image(prompt, negative_prompt, number_of_images, init_image, c
             "sampler_name": "DPM++ 2M SDE",
             "steps": 40,
             "cfg_scale": 7,
-            "width": 512,
-            "height": 512,
+            "width": SD_GENERATION_WIDTH,
+            "height": SD_GENERATION_HEIGHT,
             "n_iter": number_of_images,
             "seed": -1,
             "init_images": [init_image],  # Original image for refinement
@@ -1236,7 +2095,7 @@ def generate_next_image(prompt, negative_prompt, number_of_images, init_image, c
         # return response
 
         # Queue the task for image generation
-        task = queue_task(payload, "img2img")
+        task = queue_task(preprocess_controlnet_args(payload), "img2img", get_client_id())
         if task:
             return jsonify(task=task), 200
         else:
@@ -1291,10 +2150,140 @@ def generate_next_image_route():
         return jsonify({"error": f"An error occurred: {str(e)}"}), 500
 
 # OTHER APP ROUTES
+def accepted_image_format():
+    """First lossy result format the client explicitly accepts, or None."""
+    accepted = {mimetype for mimetype, quality in request.accept_mimetypes if quality > 0}
+    return next((image_format for image_format in RESULT_IMAGE_FORMATS if IMAGE_MIMETYPES[image_format] in accepted), None)
+
+def image_etag(file_path):
+    """Strong ETag of a served image: a hash of its bytes, computed once per file."""
+    stat = os.stat(file_path)
+    key = (file_path, stat.st_mtime_ns, stat.st_size)
+    with image_etag_lock:
+        etag = image_etags.get(key)
+        if etag:
+            image_etags.move_to_end(key)
+            return etag
+    with open(file_path, "rb") as f:
+        etag = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+    with image_etag_lock:
+        image_etags[key] = etag
+        while len(image_etags) > IMAGE_ETAG_CACHE_MAX_ENTRIES:
+            image_etags.popitem(last=False)
+    return etag
+
+def send_cached_image(file_path, mimetype, immutable=True):
+    """Send an image with a strong ETag, answering conditional and range requests.
+
+    Immutable images may be reused for IMAGE_CACHE_MAX_AGE, others are revalidated on every use.
+    """
+    max_age = IMAGE_CACHE_MAX_AGE if immutable else 0
+    etag = image_etag(file_path)
+    if request.if_none_match.contains(etag):
+        # Revalidations of an unchanged image are answered without opening it
+        response = app.response_class(status=304, mimetype=mimetype)
+        response.set_etag(etag)
+        response.cache_control.max_age = max_age
+    else:
+        response = send_file(file_path, mimetype=mimetype, etag=etag, max_age=max_age, conditional=True)
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+def send_image_file(folder, filename, default_variant=None):
+    """Send a saved image or the variant picked by the format, quality and size arguments or the Accept header."""
+    # Resolved like the save paths, against the working directory
+    file_path = os.path.abspath(os.path.join(folder, filename))
+    if not os.path.isfile(file_path):
+        return jsonify({"error": "Image not found"}), 404
+
+    variant = request.args.get('format')
+    tier = request.args.get('quality')
+    size = request.args.get('size', type=int)
+    if variant and variant not in IMAGE_MIMETYPES:
+        return jsonify({"error": f"Unknown image format: {variant}"}), 400
+    if tier and tier not in IMAGE_QUALITY_TIERS:
+        return jsonify({"error": f"Unknown quality tier: {tier}"}), 400
+    if 'size' in request.args and size not in THUMBNAIL_SIZES:
+        return jsonify({"error": f"Thumbnail size must be one of {THUMBNAIL_SIZES}"}), 400
+    # Variants are only made of originals, so requests can't chain variants of variants on disk
+    original = is_original_image(filename)
+    if not original and (variant or tier or size):
+        return jsonify({"error": "Variants can only be made of original images"}), 400
+    negotiated = not variant and original
+    if negotiated and default_variant and os.path.exists(variant_file_path(file_path, default_variant, size=size)):
+        # Default variants are only sent where they were saved, never encoded on request
+        variant, negotiated = default_variant, False
+    elif negotiated:
+        variant = accepted_image_format()
+    extension = os.path.splitext(filename)[1].lstrip('.').lower()
+    original_format = "jpeg" if extension == "jpg" else extension
+    if size and not variant:
+        variant = original_format if original_format in IMAGE_FORMATS else "png"
+
+    # Variants missing on disk are encoded on first request, the original is sent if that fails
+    variant_path = None
+    wants_variant = bool(variant) and variant_file_path(file_path, variant, tier, size) != file_path
+    if wants_variant:
+        try:
+            variant_path = encode_image_variant(file_path, variant, tier, size)
+        except Exception as e:
+            print(f"Error encoding {variant} variant of {file_path}: {e}")
+    if variant_path:
+        response = send_cached_image(variant_path, IMAGE_MIMETYPES[variant])
+    else:
+        # An original sent in place of a variant is revalidated, so the variant replaces it once it can be encoded
+        response = send_cached_image(file_path, IMAGE_MIMETYPES.get(original_format, "image/png"), immutable=not wants_variant)
+    if negotiated:
+        response.vary.add("Accept")
+    return response
+
+@app.after_request
+def cache_static_images(response):
+    """Let browsers keep the images and masks served from /static, whose filenames are never reused."""
+    if request.path.startswith(("/static/images/", "/static/masks/")) and response.status_code in (200, 206, 304):
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = IMAGE_CACHE_MAX_AGE
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    return response
+
 @app.route('/images/<filename>')
 def serve_image(filename):
     """Serve the generated image files."""
-    return send_file(os.path.join(IMAGES_FOLDER, filename), mimetype='image/png')
+    return send_image_file(IMAGES_FOLDER, filename)
+
+@app.route('/masks/<filename>')
+def serve_mask(filename):
+    """Serve the mask files, as 1-bit PNGs where the mask allows it."""
+    return send_image_file(MASKS_FOLDER, filename, default_variant="1bit")
+
+@app.route('/sdxl-styles', methods=['GET'])
+def sdxl_styles_route():
+    """Route to list the SDXL styles a generation request can select."""
+    return jsonify({"styles": list(sdxl_styles.keys()), "default": SDXL_DEFAULT_STYLE}), 200
+
+@app.route('/metrics/sd-connections', methods=['GET'])
+def sd_connection_metrics_route():
+    """Route to get connection reuse metrics of the WebUI session."""
+    return jsonify(sd_connection_metrics()), 200
+
+@app.route('/metrics/sam-cache', methods=['GET'])
+def sam_cache_metrics_route():
+    """Route to get hit and miss counts of the SAM mask cache."""
+    with sam_cache_lock:
+        return jsonify({**sam_cache_stats, "entries": len(sam_cache)}), 200
+
+@app.route('/metrics/input-images', methods=['GET'])
+def input_image_metrics_route():
+    """Route to get the bytes and time spent encoding input images."""
+    with input_image_lock:
+        stats = dict(input_image_stats)
+    stats["ms_per_image"] = stats["ms"] / stats["images"] if stats["images"] else 0.0
+    return jsonify(stats), 200
 
 @app.route('/')
 def index():
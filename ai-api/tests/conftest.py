@@ -0,0 +1,77 @@
+import os
+import sys
+import time
+from collections import OrderedDict
+import pytest
+
+AI_API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, AI_API_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# Import the server without workers, tests start them against stub backends
+os.environ["SD_URLS"] = ""
+working_directory = os.getcwd()
+os.chdir(AI_API_DIR)
+import server
+os.chdir(working_directory)
+server.COLOR_NAME_CACHE_FILE = None  # Never write the cache of the checkout at exit
+
+from stub_webui import StubWebUI
+
+@pytest.fixture(autouse=True)
+def isolated_files(tmp_path, monkeypatch):
+    """Run every test in its own folder, with no persistent caches or archives."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(server, "COLOR_NAME_CACHE_FILE", None)
+    monkeypatch.setattr(server, "TASK_ARCHIVE_FILE", str(tmp_path / "task_archive.jsonl"))
+    return tmp_path
+
+@pytest.fixture
+def task_store(monkeypatch):
+    """Give a test an empty task store, ticket counter and archive index."""
+    for name, value in (("task_index", {}), ("task_queue", []), ("running_tasks", {}), ("task_history", OrderedDict()),
+                        ("client_finish_tags", {}), ("next_ticket", 1), ("virtual_time", 0.0),
+                        ("archive_index", {}), ("archive_index_file", None)):
+        monkeypatch.setattr(server, name, value)
+
+@pytest.fixture
+def stub_webui():
+    stub = StubWebUI().start()
+    yield stub
+    stub.stop()
+
+@pytest.fixture
+def start_worker():
+    """Start task workers for backend URLs, stopping them and clearing the queue afterwards."""
+    backends = []
+
+    def start(url):
+        backend = server.start_task_worker(url)
+        backends.append(backend)
+        return backend
+
+    yield start
+    for backend in backends:
+        server.stop_task_worker(backend)
+    with server.task_lock:
+        server.task_queue.clear()
+        server.client_finish_tags.clear()
+
+def wait_for_tasks(task_ids, timeout=15):
+    """Wait until none of the tasks is pending or running, and return their statuses."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        statuses = [server.get_task_queue_status(task_id)["status"] for task_id in task_ids]
+        if not any(status in ("pending", "running") for status in statuses):
+            return statuses
+        time.sleep(0.02)
+    raise TimeoutError(f"Tasks still unfinished: {statuses}")
+
+def start_next_task():
+    """Dispatch the next queued task and mark it running, the way a worker does."""
+    with server.task_lock:
+        task = server.dispatch_next_task()
+        task["status"] = "running"
+        server.running_tasks[task["task_id"]] = task
+        server.persist_task(task)
+    return task
@@ -0,0 +1,85 @@
+import io
+import json
+import time
+import base64
+import socket
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image
+
+def png_base64(color=(255, 0, 0), size=(8, 8)):
+    """Encode a solid color PNG as base64."""
+    buffer = io.BytesIO()
+    Image.new("RGB", size, color).save(buffer, format="PNG")
+    return base64.b64encode(buffer.getvalue()).decode("utf-8")
+
+def unused_url():
+    """URL of a local port nothing listens on."""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    return f"http://127.0.0.1:{port}"
+
+class StubWebUI:
+    """Local HTTP server answering the WebUI endpoints the AI API calls, with configurable latency."""
+
+    def __init__(self, delay=0.0, delay_per_image=0.0):
+        self.delay = delay                      # Seconds every POST takes
+        self.delay_per_image = delay_per_image  # Extra seconds per generated image
+        self.calls = []                         # (path, payload) of every POST, in arrival order
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, data):
+                body = json.dumps(data).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.send_json({"progress": 0.0, "eta_relative": 0, "state": {}, "current_image": None})
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                stub.calls.append((self.path, payload))
+                if self.path.startswith("/sdapi/v1/"):
+                    image_count = payload.get("n_iter", 1) * payload.get("batch_size", 1)
+                    time.sleep(stub.delay + stub.delay_per_image * image_count)
+                    # The red channel numbers the images of a call, so tests can tell them apart
+                    self.send_json({"images": [png_base64((index, 0, 0)) for index in range(image_count)]})
+                elif self.path == "/sam/sam-predict":
+                    time.sleep(stub.delay)
+                    self.send_json({
+                        "msg": "Stub masks",
+                        "blended_images": [png_base64() for _ in range(3)],
+                        "masks": [png_base64((255, 255, 255)) for _ in range(3)],
+                        "masked_images": [png_base64() for _ in range(3)],
+                    })
+                elif self.path == "/sam/dilate-mask":
+                    time.sleep(stub.delay)
+                    self.send_json({"blended_image": png_base64(), "mask": png_base64((255, 255, 255)), "masked_image": png_base64()})
+                else:
+                    time.sleep(stub.delay)
+                    self.send_json({})
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def prompts(self):
+        """Prompts of the generation calls received, in arrival order."""
+        return [payload.get("prompt") for path, payload in self.calls if path.startswith("/sdapi/v1/")]
@@ -0,0 +1,48 @@
+import pytest
+from PIL import Image
+
+import server
+from conftest import wait_for_tasks
+
+def generation_calls(stub):
+    return [payload for path, payload in stub.calls if path.startswith("/sdapi/v1/")]
+
+def image_numbers(task_id):
+    """Numbers the stub gave the images of a task, read back from the saved files."""
+    return [Image.open(path.lstrip("/")).getpixel((0, 0))[0] for path in server.get_task_queue_status(task_id)["result"]]
+
+def run_queued(start_worker, stub, payloads):
+    """Queue tasks while no worker runs, so they wait together, then run them all on the stub."""
+    task_ids = [server.queue_task(payload, "txt2img", "client")["task_id"] for payload in payloads]
+    start_worker(stub.url)
+    assert wait_for_tasks(task_ids) == ["success"] * len(task_ids)
+    return task_ids
+
+def test_tasks_share_one_call_and_get_their_own_images(stub_webui, start_worker):
+    task_ids = run_queued(start_worker, stub_webui, [{"prompt": "room", "n_iter": n_iter} for n_iter in (1, 3, 2)])
+
+    calls = generation_calls(stub_webui)
+    assert len(calls) == 1
+    assert (calls[0]["n_iter"], calls[0]["batch_size"]) == (1, 6)
+    assert [image_numbers(task_id) for task_id in task_ids] == [[0], [1, 2, 3], [4, 5]]
+
+def test_batches_stop_at_the_size_cap(stub_webui, start_worker, monkeypatch):
+    monkeypatch.setattr(server, "SD_MAX_BATCH_SIZE", 4)
+    task_ids = run_queued(start_worker, stub_webui, [{"prompt": "room", "n_iter": n_iter} for n_iter in (1, 2, 2, 1)])
+
+    assert [call.get("batch_size", 1) * call["n_iter"] for call in generation_calls(stub_webui)] == [3, 3]
+    assert [image_numbers(task_id) for task_id in task_ids] == [[0], [1, 2], [0, 1], [2]]
+
+def test_tasks_with_different_prompts_are_not_batched(stub_webui, start_worker):
+    task_ids = run_queued(start_worker, stub_webui, [{"prompt": prompt, "n_iter": 1} for prompt in ("room", "sofa", "room")])
+
+    assert stub_webui.prompts() == ["room", "sofa", "room"]
+    assert [image_numbers(task_id) for task_id in task_ids] == [[0], [0], [0]]
+
+def test_controlnet_tasks_are_not_batched(stub_webui, start_worker):
+    controlnet = {"controlnet": {"args": [{"module": "none", "model": "canny"}]}}
+    task_ids = run_queued(start_worker, stub_webui, [{"prompt": "room", "n_iter": 2, "alwayson_scripts": controlnet} for _ in range(2)])
+
+    assert [call["n_iter"] for call in generation_calls(stub_webui)] == [2, 2]
+    assert all("batch_size" not in call for call in generation_calls(stub_webui))
+    assert [image_numbers(task_id) for task_id in task_ids] == [[0, 1], [0, 1]]
@@ -0,0 +1,92 @@
+import threading
+import time
+import numpy as np
+import pytest
+
+import server
+
+class StubColorService:
+    """Stands in for thecolorapi, answering after a per-color delay."""
+
+    def __init__(self, delays=None, default_delay=0.2):
+        self.delays = delays or {}
+        self.default_delay = default_delay
+        self.active = 0
+        self.max_active = 0
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def __call__(self, hex_code):
+        with self.lock:
+            self.calls.append(hex_code)
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            delay = self.delays.get(hex_code, self.default_delay)
+            if delay is None:
+                return hex_code  # Like thecolorapi_hex_to_color_name when the API errors
+            time.sleep(delay)
+            return f"Api {hex_code}"
+        finally:
+            with self.lock:
+                self.active -= 1
+
+@pytest.fixture
+def color_service(monkeypatch):
+    service = StubColorService()
+    monkeypatch.setattr(server, "thecolorapi_hex_to_color_name", service)
+    monkeypatch.setattr(server, "COLOR_NAME_REMOTE_LOOKUP", True)
+    monkeypatch.setattr(server, "COLOR_LOOKUP_DEADLINE_SECONDS", 1.0)
+    monkeypatch.setattr(server, "color_name_cache", {})
+    monkeypatch.setattr(server, "color_lookups_pending", {})
+    return service
+
+def test_misses_are_looked_up_concurrently(color_service):
+    palette = ["#ff0000", "#00ff00", "#0000ff", "#123456"]
+
+    start = time.monotonic()
+    names = server.resolve_color_names(palette)
+    elapsed = time.monotonic() - start
+
+    assert names == [f"Api {hex_code}" for hex_code in palette]
+    # Four 0.2 s lookups take about 0.2 s, not 0.8 s
+    assert elapsed < 0.6
+    assert color_service.max_active == min(len(palette), server.COLOR_LOOKUP_WORKERS)
+
+def test_cached_names_skip_the_service(color_service):
+    server.resolve_color_names(["#ff0000"])
+    color_service.calls.clear()
+
+    assert server.resolve_color_names(["#FF0000", "f00"]) == ["Api #ff0000", "Api #ff0000"]
+    assert color_service.calls == []
+
+def test_deadline_falls_back_to_offline_names(color_service):
+    color_service.delays = {"#ff0000": 0.05, "#000080": 1.5}
+
+    start = time.monotonic()
+    names = server.resolve_color_names(["#ff0000", "#000080"])
+    elapsed = time.monotonic() - start
+
+    assert server.COLOR_LOOKUP_DEADLINE_SECONDS <= elapsed < server.COLOR_LOOKUP_DEADLINE_SECONDS + 0.5
+    assert names == ["Api #ff0000", "Navy"]
+
+def test_failed_lookup_falls_back_to_offline_name(color_service):
+    color_service.delays = {"#00ff00": None}
+
+    assert server.resolve_color_names(["#00ff00"]) == ["Lime"]
+    assert "#00ff00" not in server.color_name_cache
+
+def test_without_offline_table_falls_back_to_hex(color_service, monkeypatch):
+    monkeypatch.setattr(server, "COLOR_LOOKUP_DEADLINE_SECONDS", 0.2)
+    monkeypatch.setattr(server, "named_color_names", [])
+    monkeypatch.setattr(server, "named_color_lab", np.empty((0, 3), dtype=np.float32))
+    color_service.delays = {"#abcdef": 0.6}
+
+    assert server.resolve_color_names(["#abcdef", "not a color"]) == ["#abcdef", "not a color"]
+
+def test_zero_deadline_never_waits(color_service, monkeypatch):
+    monkeypatch.setattr(server, "COLOR_LOOKUP_DEADLINE_SECONDS", 0)
+
+    start = time.monotonic()
+    assert server.resolve_color_names(["#ff0000"]) == ["Red"]
+    assert time.monotonic() - start < 0.1
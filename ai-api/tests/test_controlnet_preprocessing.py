@@ -0,0 +1,70 @@
+import base64
+import cv2
+import numpy as np
+import pytest
+
+import server
+
+def pad64(x):
+    return int(np.ceil(float(x) / 64.0) * 64 - x)
+
+def reference_resize_image_with_pad(img, resolution):
+    """resize_image_with_pad of ControlNet 1.1's annotator utilities."""
+    H_raw, W_raw, _ = img.shape
+    k = float(resolution) / float(min(H_raw, W_raw))
+    interpolation = cv2.INTER_CUBIC if k > 1 else cv2.INTER_AREA
+    H_target = int(np.round(float(H_raw) * k))
+    W_target = int(np.round(float(W_raw) * k))
+    img = cv2.resize(img, (W_target, H_target), interpolation=interpolation)
+    H_pad, W_pad = pad64(H_target), pad64(W_target)
+    img_padded = np.pad(img, [[0, H_pad], [0, W_pad], [0, 0]], mode='edge')
+
+    def remove_pad(x):
+        return np.ascontiguousarray(x[:H_target, :W_target].copy())
+
+    return np.ascontiguousarray(img_padded.copy()), remove_pad
+
+def reference_canny(img, res=512, thr_a=100, thr_b=200):
+    """The "canny" preprocessor of ControlNet 1.1, on an RGB image."""
+    img, remove_pad = reference_resize_image_with_pad(img, res)
+    return remove_pad(cv2.Canny(img, thr_a, thr_b))
+
+def photo(height, width, seed=0):
+    """Image with shapes and noise, so the edge map has plenty of detail to compare."""
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 128, dtype=np.uint8)
+    for _ in range(12):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        color = tuple(int(value) for value in rng.integers(0, 256, 3))
+        cv2.circle(image, (x, y), int(rng.integers(10, min(height, width) // 3)), color, -1)
+    return np.clip(image + rng.integers(-6, 6, image.shape), 0, 255).astype(np.uint8)
+
+@pytest.mark.parametrize("height, width, resolution", [(512, 910, 512), (768, 512, 512), (200, 300, 512), (1080, 1920, 512), (333, 517, 384)])
+def test_canny_matches_controlnet(height, width, resolution):
+    image_bgr = photo(height, width)
+    expected = reference_canny(cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB), resolution)
+
+    edges = server.preprocess_canny(image_bgr, resolution)
+
+    assert edges.shape[:2] == expected.shape
+    np.testing.assert_array_equal(edges[:, :, 0], expected)
+
+@pytest.mark.parametrize("height, width", [(512, 910), (768, 512)])
+def test_preprocessed_maps_keep_the_aspect_ratio(height, width):
+    image_bgr = photo(height, width)
+    for preprocessor in server.CONTROLNET_PREPROCESSORS.values():
+        map_height, map_width = preprocessor(image_bgr, 512).shape[:2]
+        assert min(map_height, map_width) == 512
+        assert abs(map_width / map_height - width / height) < 0.01
+
+def test_controlnet_image_is_preprocessed_at_the_pixel_perfect_resolution(monkeypatch):
+    monkeypatch.setattr(server, "controlnet_cache", server.OrderedDict())
+    image_bgr = photo(512, 910)
+    image_base64 = base64.b64encode(cv2.imencode('.png', image_bgr)[1]).decode('utf-8')
+
+    preprocessed = server.preprocess_controlnet_image(image_base64, "canny", 512, 512)
+    edges = cv2.imdecode(np.frombuffer(base64.b64decode(preprocessed), np.uint8), cv2.IMREAD_GRAYSCALE)
+
+    # "Scale to Fit (Inner Fit)" fits the 910 px side in 512 px
+    np.testing.assert_array_equal(edges, reference_canny(cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB), 288))
+    assert server.preprocess_controlnet_image(image_base64, "canny", 512, 512) is preprocessed
@@ -0,0 +1,89 @@
+import pytest
+
+import server
+
+pytestmark = pytest.mark.usefixtures("task_store")
+
+def queue(client_id, n_iter=1, type="txt2img", prompt="room"):
+    return server.queue_task({"prompt": prompt, "n_iter": n_iter}, type, client_id)["task_id"]
+
+def start_next_batch(batch=True):
+    """Dispatch the next task, with its batch companions unless batch is False, and mark them running like a worker."""
+    with server.task_lock:
+        task = server.dispatch_next_task()
+        tasks = [task] + (server.take_batch_companions(task) if batch else [])
+        for task in tasks:
+            task["status"] = "running"
+            server.running_tasks[task["task_id"]] = task
+    return [task["task_id"] for task in tasks]
+
+def reported_order():
+    """Pending task_ids by the positions clients are told, checking the positions are consecutive."""
+    with server.task_lock:
+        pending = [task_id for task_id, task in server.task_index.items() if task["status"] == "pending"]
+        positions = {task_id: server.get_task_queue_status(task_id)["position"] for task_id in pending}
+        first_position = 2 if server.running_tasks else 1
+    order = sorted(pending, key=positions.get)
+    assert [positions[task_id] for task_id in order] == list(range(first_position, first_position + len(order)))
+    return order
+
+def dispatch_all(batch=False):
+    """Run every queued task, checking that the positions reported before and while tasks run predict the dispatch order."""
+    dispatched = []
+    expected = reported_order()
+    while server.task_queue:
+        started = start_next_batch(batch)
+        assert started == expected[:len(started)]
+        # While the tasks run, the others have moved up behind them in the same order
+        expected = expected[len(started):]
+        assert reported_order() == expected
+        dispatched.append(started if batch else started[0])
+        server.running_tasks.clear()
+        for task_id in started:
+            server.task_index[task_id]["status"] = "success"
+    return dispatched
+
+def test_clients_are_interleaved():
+    a = [queue("a") for _ in range(3)]
+    b = [queue("b") for _ in range(3)]
+
+    assert dispatch_all() == [a[0], b[0], a[1], b[1], a[2], b[2]]
+
+def test_cheap_tasks_overtake_a_heavy_task_without_starving_it():
+    heavy = queue("heavy", n_iter=4, type="img2img")  # Finish tag 4 / weight 1 = 4
+    previews = [queue("light") for _ in range(20)]    # Finish tags 0.25, 0.5, ..., 5
+
+    order = dispatch_all()
+
+    # Previews finishing before 4 go first, the heavy task wins the tie at 4 by its earlier ticket
+    assert order == previews[:15] + [heavy] + previews[15:]
+
+def test_lane_weights_share_the_backend():
+    inpaints = [queue("inpaint", n_iter=2, type="img2img") for _ in range(3)]  # 2 images / weight 1
+    generations = [queue("generate", n_iter=2) for _ in range(6)]             # 2 images / weight 2
+
+    order = dispatch_all()
+
+    # txt2img tasks get twice the share of img2img tasks with as many images
+    assert order == [generations[0], inpaints[0], generations[1], generations[2], inpaints[1],
+                     generations[3], generations[4], inpaints[2], generations[5]]
+
+def test_positions_match_dispatch_while_a_task_runs():
+    running = queue("a")
+    start_next_batch()
+    waiting = [queue("b"), queue("a"), queue("c", n_iter=3, type="img2img"), queue("b")]
+
+    order = reported_order()
+    assert server.get_task_queue_status(running)["position"] == 1
+    assert set(order) == set(waiting)
+    server.running_tasks.clear()
+    server.task_index[running]["status"] = "success"
+    assert dispatch_all() == order
+
+def test_positions_match_dispatch_with_batches():
+    # Same-prompt tasks of several clients share batches, other prompts break the run
+    task_ids = [queue("a"), queue("b"), queue("c"), queue("a", prompt="sofa"), queue("b"), queue("c")]
+
+    batches = dispatch_all(batch=True)
+
+    assert batches == [task_ids[:3], [task_ids[3]], task_ids[4:]]
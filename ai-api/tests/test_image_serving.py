@@ -0,0 +1,84 @@
+import os
+import pytest
+from PIL import Image
+
+import server
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+@pytest.fixture
+def image_name():
+    os.makedirs(server.IMAGES_FOLDER, exist_ok=True)
+    Image.new("RGB", (32, 32), (200, 30, 30)).save(os.path.join(server.IMAGES_FOLDER, "room.png"))
+    return "room.png"
+
+def test_original_is_immutable_and_revalidates_with_304(client, image_name):
+    response = client.get(f"/images/{image_name}")
+    assert response.status_code == 200
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == server.IMAGE_CACHE_MAX_AGE
+
+    revalidated = client.get(f"/images/{image_name}", headers={"If-None-Match": response.headers["ETag"]})
+    assert revalidated.status_code == 304
+    assert revalidated.cache_control.immutable
+
+def test_requested_variant_is_immutable(client, image_name):
+    response = client.get(f"/images/{image_name}?format=webp&quality=low")
+    assert response.status_code == 200
+    assert response.mimetype == "image/webp"
+    assert response.cache_control.immutable
+
+def test_original_sent_for_failed_variant_is_not_immutable(client, image_name, monkeypatch):
+    def fail(*args, **kwargs):
+        raise OSError("encoder missing")
+    monkeypatch.setattr(server, "encode_image_variant", fail)
+
+    for query in ("format=webp", "size=128"):
+        response = client.get(f"/images/{image_name}?{query}")
+        assert response.status_code == 200
+        assert response.mimetype == "image/png"
+        assert not response.cache_control.immutable
+        assert response.cache_control.no_cache
+        assert response.cache_control.max_age == 0
+
+        revalidated = client.get(f"/images/{image_name}?{query}", headers={"If-None-Match": response.headers["ETag"]})
+        assert revalidated.status_code == 304
+        assert not revalidated.cache_control.immutable
+
+def saved_files():
+    return sorted(os.listdir(server.IMAGES_FOLDER))
+
+def test_variants_of_variants_are_rejected(client, image_name):
+    assert client.get(f"/images/{image_name}?format=webp&quality=low").status_code == 200
+    files = saved_files()
+    assert files == ["room.low.webp", "room.png"]
+
+    for query in ("format=webp&quality=high", "format=png", "quality=low"):
+        response = client.get(f"/images/room.low.webp?{query}")
+        assert response.status_code == 400
+    assert saved_files() == files
+
+def test_variant_is_served_as_is_without_arguments(client, image_name):
+    client.get(f"/images/{image_name}?format=webp&quality=low")
+    files = saved_files()
+
+    response = client.get("/images/room.low.webp", headers={"Accept": "image/avif,image/webp"})
+    assert response.status_code == 200
+    assert response.mimetype == "image/webp"
+    assert "Accept" not in response.vary
+    assert saved_files() == files
+
+def test_directories_are_not_found(client, image_name):
+    assert client.get("/images/..").status_code == 404
+    assert client.get("/images/.").status_code == 404
+
+def test_thumbnails_of_thumbnails_are_rejected(client, image_name):
+    assert client.get(f"/images/{image_name}?size=128").status_code == 200
+    files = saved_files()
+    assert files == ["room.128.png", "room.png"]
+
+    for query in ("size=128", "size=256", "size=128&format=webp"):
+        assert client.get(f"/images/room.128.png?{query}").status_code == 400
+    assert saved_files() == files
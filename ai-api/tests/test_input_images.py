@@ -0,0 +1,55 @@
+import io
+import base64
+from collections import OrderedDict
+import cv2
+import numpy as np
+import pytest
+from PIL import Image, ImageOps
+
+import server
+
+@pytest.fixture(autouse=True)
+def empty_input_cache(monkeypatch):
+    monkeypatch.setattr(server, "input_image_cache", OrderedDict())
+
+def jpeg_bytes(size, orientation=1):
+    """JPEG whose stored left half is red and right half blue, with an EXIF orientation tag."""
+    image = Image.new("RGB", size, (0, 0, 255))
+    image.paste((255, 0, 0), (0, 0, size[0] // 2, size[1]))
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=95, exif=exif.tobytes())
+    return buffer.getvalue()
+
+def load(image_bytes):
+    encoded_image = server.load_and_encode_image(io.BytesIO(image_bytes))
+    return base64.b64decode(encoded_image)
+
+def decode_rgb(encoded_bytes):
+    """Decode pixels as stored, like the WebUI, which ignores EXIF orientation."""
+    return cv2.cvtColor(cv2.imdecode(np.frombuffer(encoded_bytes, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION), cv2.COLOR_BGR2RGB)
+
+def test_upright_small_jpeg_is_passed_through():
+    image_bytes = jpeg_bytes((200, 100))
+    assert load(image_bytes) == image_bytes
+
+def test_rotated_small_jpeg_is_turned_upright():
+    image_bytes = jpeg_bytes((200, 100), orientation=6)
+    expected = np.array(ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes))).convert("RGB"))
+
+    encoded_bytes = load(image_bytes)
+
+    assert encoded_bytes != image_bytes
+    np.testing.assert_array_equal(decode_rgb(encoded_bytes), expected)
+
+@pytest.mark.parametrize("normalization", [True, False])
+def test_rotated_large_jpeg_is_turned_upright_before_downscaling(monkeypatch, normalization):
+    monkeypatch.setattr(server, "INPUT_NORMALIZATION", normalization)
+    # Stored 2048x1024 with orientation 6, shown 1024x2048 with the red half on top
+    image_np = decode_rgb(load(jpeg_bytes((2048, 1024), orientation=6)))
+
+    height, width = image_np.shape[:2]
+    assert (width, height) == ((512, 1024) if normalization else (1024, 2048))
+    assert np.abs(image_np[height // 4, width // 2].astype(int) - [255, 0, 0]).max() < 16
+    assert np.abs(image_np[3 * height // 4, width // 2].astype(int) - [0, 0, 255]).max() < 16
@@ -0,0 +1,100 @@
+import base64
+import cv2
+import numpy as np
+import pytest
+
+import server
+
+def threshold(mask, value):
+    return cv2.threshold(mask, value, 255, cv2.THRESH_BINARY)[1]
+
+def reference_user_mask(user_mask, shape):
+    """User mask preparation of the previous combine_masks/subtract_masks, None where they skipped it."""
+    if user_mask is None or np.count_nonzero(user_mask) == 0:
+        return None
+    return threshold(cv2.resize(user_mask, (shape[1], shape[0])), 127)
+
+def reference_add(mask, user_mask):
+    return mask if user_mask is None else threshold(cv2.addWeighted(mask, 1, user_mask, 1, 0), 1)
+
+def reference_remove(mask, user_mask):
+    return mask if user_mask is None else threshold(cv2.subtract(mask, user_mask), 1)
+
+def reference_preview(refine_option, sam_mask, user_mask_add, user_mask_remove):
+    """The addWeighted/subtract chain the preview masks were composed with before compose_masks."""
+    sam_mask = threshold(sam_mask, 127)
+    user_mask_add = reference_user_mask(user_mask_add, sam_mask.shape)
+    user_mask_remove = reference_user_mask(user_mask_remove, sam_mask.shape)
+    if refine_option == 0:
+        return reference_remove(reference_add(sam_mask, user_mask_add), user_mask_remove)
+    return reference_add(reference_remove(sam_mask, user_mask_remove), user_mask_add)
+
+def soft_mask(height, width, seed):
+    """Anti-aliased grayscale strokes, like a mask drawn in the browser."""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    for _ in range(5):
+        points = rng.integers(0, [width, height], (2, 2))
+        cv2.line(mask, tuple(int(v) for v in points[0]), tuple(int(v) for v in points[1]), int(rng.integers(60, 256)),
+                 int(rng.integers(2, 12)), lineType=cv2.LINE_AA)
+    return mask
+
+def encode(mask):
+    return base64.b64encode(cv2.imencode('.png', mask)[1]).decode('utf-8')
+
+USER_MASKS = {
+    "drawn": lambda seed: soft_mask(48, 64, seed),
+    "other_size": lambda seed: soft_mask(24, 32, seed),
+    "empty": lambda seed: np.zeros((48, 64), dtype=np.uint8),
+    "missing": lambda seed: None,
+}
+
+@pytest.mark.parametrize("remove_name", sorted(USER_MASKS))
+@pytest.mark.parametrize("add_name", sorted(USER_MASKS))
+@pytest.mark.parametrize("refine_option", [0, 1])
+def test_compose_masks_matches_previous_chain(refine_option, add_name, remove_name):
+    sam_mask = soft_mask(48, 64, seed=0)
+    user_mask_add, user_mask_remove = USER_MASKS[add_name](1), USER_MASKS[remove_name](2)
+    expected = reference_preview(refine_option, sam_mask, user_mask_add, user_mask_remove)
+
+    binary_sam_mask = threshold(sam_mask, 127)
+    composed = server.compose_masks(
+        binary_sam_mask,
+        server.load_user_mask(encode(user_mask_add) if user_mask_add is not None else None, binary_sam_mask.shape),
+        server.load_user_mask(encode(user_mask_remove) if user_mask_remove is not None else None, binary_sam_mask.shape),
+        refine_option,
+    )
+
+    np.testing.assert_array_equal(composed, expected)
+
+def test_options_differ_where_added_and_removed_areas_overlap():
+    sam_mask = np.zeros((8, 8), dtype=np.uint8)
+    user_mask = np.zeros((8, 8), dtype=np.uint8)
+    user_mask[2:6, 2:6] = 255
+
+    assert not server.compose_masks(sam_mask, user_mask, user_mask, 0).any()
+    np.testing.assert_array_equal(server.compose_masks(sam_mask, user_mask, user_mask, 1), user_mask)
+
+def test_compose_masks_leaves_its_inputs_alone():
+    sam_mask, user_mask = threshold(soft_mask(48, 64, 0), 127), threshold(soft_mask(48, 64, 1), 127)
+    copies = sam_mask.copy(), user_mask.copy()
+
+    server.compose_masks(sam_mask, user_mask, user_mask, 1)
+
+    np.testing.assert_array_equal(sam_mask, copies[0])
+    np.testing.assert_array_equal(user_mask, copies[1])
+
+@pytest.mark.parametrize("refine_option", [0, 1])
+def test_preview_mask_saves_the_composed_mask(refine_option):
+    sam_mask, user_mask_add, user_mask_remove = (soft_mask(48, 64, seed) for seed in range(3))
+    expected = reference_preview(refine_option, sam_mask, user_mask_add, user_mask_remove)
+
+    paths = server.preview_mask(refine_option, encode(sam_mask), encode(user_mask_add), encode(user_mask_remove))
+
+    np.testing.assert_array_equal(cv2.imread(paths["mask"].lstrip("/"), cv2.IMREAD_GRAYSCALE), expected)
+    masked_image = cv2.imread(paths["masked_image"].lstrip("/"), cv2.IMREAD_UNCHANGED)
+    np.testing.assert_array_equal(masked_image[:, :, 3], expected)
+    assert (masked_image[:, :, :3] == 255).all()
+
+def test_preview_mask_rejects_unknown_option():
+    assert server.preview_mask(2, encode(soft_mask(48, 64, 0)), None, None)["error_status"] == 500
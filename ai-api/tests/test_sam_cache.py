@@ -0,0 +1,76 @@
+import io
+import os
+from collections import OrderedDict
+import pytest
+from PIL import Image
+
+import server
+
+@pytest.fixture(autouse=True)
+def sam_backend(stub_webui, monkeypatch):
+    """Send SAM calls to the stub WebUI with an empty SAM cache."""
+    monkeypatch.setattr(server, "SD_URL", stub_webui.url)
+    monkeypatch.setattr(server, "sam_cache", OrderedDict())
+    monkeypatch.setattr(server, "sam_cache_stats", {"hits": 0, "misses": 0})
+    return stub_webui
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+def request_mask(client, mask_prompt, color=(10, 120, 200)):
+    buffer = io.BytesIO()
+    Image.new("RGB", (64, 64), color).save(buffer, format="PNG")
+    buffer.seek(0)
+    response = client.post("/generate-sam-mask", data={"mask_prompt": mask_prompt, "init_image": (buffer, "room.png")},
+                           content_type="multipart/form-data")
+    assert response.status_code == 200
+    return response.get_json()["image_paths"]
+
+def predict_calls(stub):
+    return sum(path == "/sam/sam-predict" for path, payload in stub.calls)
+
+def test_repeated_requests_hit_the_cache(client, sam_backend):
+    image_paths = request_mask(client, "sofa")
+
+    assert request_mask(client, " Sofa ") == image_paths
+    assert request_mask(client, "sofa", color=(0, 0, 0)) != image_paths
+    assert predict_calls(sam_backend) == 2
+    assert server.sam_cache_stats == {"hits": 1, "misses": 2}
+
+def test_least_recently_used_entry_is_evicted(client, sam_backend, monkeypatch):
+    monkeypatch.setattr(server, "SAM_CACHE_MAX_ENTRIES", 2)
+    for mask_prompt in ("sofa", "lamp", "sofa", "rug"):  # The read of sofa keeps it over lamp
+        request_mask(client, mask_prompt)
+    assert predict_calls(sam_backend) == 3
+
+    request_mask(client, "sofa")
+    assert predict_calls(sam_backend) == 3
+    request_mask(client, "lamp")
+    assert predict_calls(sam_backend) == 4
+
+def test_entry_with_missing_files_is_regenerated(client, sam_backend):
+    image_paths = request_mask(client, "sofa")
+    os.remove(image_paths["masks"][1].lstrip("/"))
+
+    regenerated = request_mask(client, "sofa")
+
+    assert regenerated != image_paths
+    assert all(os.path.exists(path.lstrip("/")) for paths in regenerated.values() for path in paths)
+    assert predict_calls(sam_backend) == 2
+    assert request_mask(client, "sofa") == regenerated
+
+def test_undilated_masks_are_not_cached(client, sam_backend, monkeypatch):
+    dilate_sam_masks = server.dilate_sam_masks
+
+    def fail(*args):
+        raise ValueError("dilation failed")
+    monkeypatch.setattr(server, "dilate_sam_masks", fail)
+    request_mask(client, "sofa")
+    assert len(server.sam_cache) == 0
+
+    monkeypatch.setattr(server, "dilate_sam_masks", dilate_sam_masks)
+    dilated = request_mask(client, "sofa")
+    assert predict_calls(sam_backend) == 2
+    assert request_mask(client, "sofa") == dilated
+    assert predict_calls(sam_backend) == 2
@@ -0,0 +1,113 @@
+import base64
+import cv2
+import numpy as np
+import pytest
+from scipy.ndimage import binary_dilation
+
+import server
+
+def reference_dilate_mask(mask, dilation_amt):
+    """dilate_mask of the SAM extension."""
+    x, y = np.meshgrid(np.arange(dilation_amt), np.arange(dilation_amt))
+    center = dilation_amt // 2
+    dilation_kernel = ((x - center) ** 2 + (y - center) ** 2 <= center ** 2).astype(np.uint8)
+    return binary_dilation(mask, dilation_kernel)
+
+def reference_update_mask(image_rgba, mask, dilation_amt):
+    """Mask and matted image of the SAM extension's update_mask, behind /sam/dilate-mask."""
+    binary_img = mask >= 128
+    if dilation_amt:
+        binary_img = reference_dilate_mask(binary_img, dilation_amt)
+    matted_image = image_rgba.copy()
+    matted_image[~binary_img] = np.array([0, 0, 0, 0])
+    return binary_img.astype(np.uint8) * 255, matted_image
+
+def encode(image_np):
+    return base64.b64encode(cv2.imencode('.png', image_np)[1]).decode('utf-8')
+
+def decode(image_base64):
+    return cv2.imdecode(np.frombuffer(base64.b64decode(image_base64), np.uint8), cv2.IMREAD_UNCHANGED)
+
+def random_image(height, width, channels=4):
+    return np.random.default_rng(height * width + channels).integers(0, 256, (height, width, channels), dtype=np.uint8)
+
+def blob_mask(height, width, seed=0):
+    """Irregular mask made of a few random rectangles and circles."""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((height, width), dtype=np.uint8)
+    for _ in range(4):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        cv2.circle(mask, (x, y), int(rng.integers(3, 20)), 255, -1)
+        cv2.rectangle(mask, (x, y), (x + int(rng.integers(1, 15)), y + int(rng.integers(1, 15))), 255, -1)
+    return mask
+
+def border_mask(height, width):
+    """Mask touching every edge and corner of the image."""
+    mask = np.zeros((height, width), dtype=np.uint8)
+    mask[0, :] = 255
+    mask[:, -1] = 255
+    mask[-3:, :4] = 255
+    mask[height // 2, 0] = 255
+    return mask
+
+def single_pixel_mask(height, width):
+    mask = np.zeros((height, width), dtype=np.uint8)
+    mask[height // 3, width // 4] = 255
+    return mask
+
+MASKS = {
+    "blobs": blob_mask,
+    "border": border_mask,
+    "single_pixel": single_pixel_mask,
+    "empty": lambda height, width: np.zeros((height, width), dtype=np.uint8),
+    "full": lambda height, width: np.full((height, width), 255, dtype=np.uint8),
+}
+
+@pytest.mark.parametrize("dilate_amount", [0, 1, 2, 4, 7, 10, 15])
+@pytest.mark.parametrize("mask_name", sorted(MASKS))
+def test_dilation_matches_extension(mask_name, dilate_amount):
+    height, width = 48, 64
+    image_rgba = random_image(height, width)
+    mask = MASKS[mask_name](height, width)
+    expected_mask, expected_matted = reference_update_mask(image_rgba, mask, dilate_amount)
+
+    reply = server.dilate_sam_masks(encode(cv2.cvtColor(image_rgba, cv2.COLOR_RGBA2BGRA)), [encode(mask)], dilate_amount)
+
+    np.testing.assert_array_equal(decode(reply["masks"][0]), expected_mask)
+    np.testing.assert_array_equal(cv2.cvtColor(decode(reply["masked_images"][0]), cv2.COLOR_BGRA2RGBA), expected_matted)
+
+def test_blended_image_only_changes_the_dilated_area():
+    image_rgba = random_image(48, 64)
+    mask = blob_mask(48, 64, seed=3)
+    expected_mask, _ = reference_update_mask(image_rgba, mask, 10)
+
+    reply = server.dilate_sam_masks(encode(cv2.cvtColor(image_rgba, cv2.COLOR_RGBA2BGRA)), [encode(mask)], 10)
+    blended = cv2.cvtColor(decode(reply["blended_images"][0]), cv2.COLOR_BGRA2RGBA)
+
+    outside = expected_mask == 0
+    np.testing.assert_array_equal(blended[outside], image_rgba[outside])
+    overlay = (np.array(server.SAM_BLEND_COLOR, dtype=np.float32) * 255 * 0.5)
+    np.testing.assert_array_equal(blended[~outside], (image_rgba[~outside] * 0.5 + overlay).astype(np.uint8))
+
+def test_rgb_input_and_every_mask_are_dilated():
+    image_rgb = random_image(40, 30, channels=3)
+    masks = [blob_mask(40, 30, seed) for seed in range(3)]
+    image_rgba = cv2.cvtColor(image_rgb, cv2.COLOR_RGB2RGBA)
+
+    reply = server.dilate_sam_masks(encode(cv2.cvtColor(image_rgb, cv2.COLOR_RGB2BGR)), [encode(mask) for mask in masks], 7)
+
+    assert [len(reply[key]) for key in ("blended_images", "masks", "masked_images")] == [3, 3, 3]
+    for mask, mask_base64, matted_base64 in zip(masks, reply["masks"], reply["masked_images"]):
+        expected_mask, expected_matted = reference_update_mask(image_rgba, mask, 7)
+        np.testing.assert_array_equal(decode(mask_base64), expected_mask)
+        np.testing.assert_array_equal(cv2.cvtColor(decode(matted_base64), cv2.COLOR_BGRA2RGBA), expected_matted)
+
+def test_mask_of_another_size_is_resized_to_the_image():
+    image_rgba = random_image(48, 64)
+    mask = blob_mask(24, 32, seed=5)
+    resized = cv2.resize(mask, (64, 48), interpolation=cv2.INTER_NEAREST)
+    expected_mask, _ = reference_update_mask(image_rgba, resized, 4)
+
+    reply = server.dilate_sam_masks(encode(cv2.cvtColor(image_rgba, cv2.COLOR_RGBA2BGRA)), [encode(mask)], 4)
+
+    np.testing.assert_array_equal(decode(reply["masks"][0]), expected_mask)
@@ -0,0 +1,110 @@
+import time
+import threading
+import pytest
+
+import server
+from conftest import wait_for_tasks
+from stub_webui import StubWebUI, unused_url
+
+@pytest.fixture(autouse=True)
+def fast_health_checks(monkeypatch):
+    monkeypatch.setattr(server, "SD_BACKEND_RETRY_SECONDS", 0.1)
+
+def test_tasks_run_on_stub_backend(stub_webui, start_worker):
+    start_worker(stub_webui.url)
+    task_ids = [server.queue_task({"prompt": f"room {i}", "n_iter": 1}, "txt2img", f"client-{i}")["task_id"] for i in range(3)]
+
+    assert wait_for_tasks(task_ids) == ["success"] * 3
+    assert sorted(stub_webui.prompts()) == ["room 0", "room 1", "room 2"]
+    for task_id in task_ids:
+        assert len(server.get_task_queue_status(task_id)["result"]) == 1
+
+def test_only_backend_down_fails_task(start_worker):
+    start_worker(unused_url())
+    task_id = server.queue_task({"prompt": "room", "n_iter": 1}, "txt2img")["task_id"]
+
+    # With no other backend to take it, the task fails instead of waiting for the WebUI forever
+    assert wait_for_tasks([task_id]) == ["failed"]
+
+def test_tasks_of_down_backend_move_to_healthy_backend(stub_webui, start_worker):
+    dead_backend = start_worker(unused_url())
+    start_worker(stub_webui.url)
+    task_ids = [server.queue_task({"prompt": f"room {i}", "n_iter": 1}, "txt2img", f"client-{i}")["task_id"] for i in range(4)]
+
+    assert wait_for_tasks(task_ids) == ["success"] * 4
+    assert sorted(stub_webui.prompts()) == [f"room {i}" for i in range(4)]
+    assert not dead_backend["healthy"]
+
+def test_tasks_spread_over_backends(start_worker):
+    stubs = [StubWebUI(delay=0.2).start() for _ in range(2)]
+    try:
+        for stub in stubs:
+            start_worker(stub.url)
+        task_ids = [server.queue_task({"prompt": f"room {i}", "n_iter": 1}, "txt2img", f"client-{i}")["task_id"] for i in range(4)]
+
+        assert wait_for_tasks(task_ids) == ["success"] * 4
+        assert all(stub.prompts() for stub in stubs)
+    finally:
+        for stub in stubs:
+            stub.stop()
+
+def test_stopped_worker_exits_when_its_url_is_restarted(start_worker):
+    stub = StubWebUI(delay=0.3).start()
+    try:
+        server.stop_task_worker(start_worker(stub.url))
+        start_worker(stub.url)
+        start = time.monotonic()
+        task_ids = [server.queue_task({"prompt": f"room {i}", "n_iter": 1}, "txt2img", f"client-{i}")["task_id"] for i in range(2)]
+
+        assert wait_for_tasks(task_ids) == ["success"] * 2
+        # One worker runs the tasks one after the other, the stopped one takes none
+        assert time.monotonic() - start >= 0.55
+    finally:
+        stub.stop()
+
+def test_tasks_succeed_before_their_variants_are_encoded(stub_webui, start_worker, monkeypatch):
+    variants_released = threading.Event()
+    variant_calls = []
+
+    def save_image_variants(image_paths, variants, sizes=(None,)):
+        variants_released.wait(5)
+        variant_calls.append(list(image_paths))
+    monkeypatch.setattr(server, "save_image_variants", save_image_variants)
+    start_worker(stub_webui.url)
+    task_id = server.queue_task({"prompt": "room", "n_iter": 2}, "txt2img")["task_id"]
+
+    try:
+        assert wait_for_tasks([task_id]) == ["success"]
+        assert variant_calls == []
+    finally:
+        variants_released.set()
+    deadline = time.monotonic() + 5
+    while not variant_calls and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert variant_calls == [server.get_task_queue_status(task_id)["result"]]
+
+def test_requeued_task_is_not_failed_by_its_first_worker(start_worker, monkeypatch):
+    stub = StubWebUI(delay=0.3).start()
+    execute_task, finish_task = server.execute_task, server.finish_task
+    handed_over, statuses = [], []
+
+    def hand_over_first_batch(tasks, type, backend):
+        if handed_over:
+            return execute_task(tasks, type, backend)
+        # Give the batch to the other worker on the same URL, as a connection failure would
+        handed_over.append(backend)
+        server.requeue_tasks(tasks)
+        deadline = time.monotonic() + 5
+        while tasks[0]["status"] != "running" and time.monotonic() < deadline:
+            time.sleep(0.01)
+    monkeypatch.setattr(server, "execute_task", hand_over_first_batch)
+    monkeypatch.setattr(server, "finish_task", lambda task, status, result=None: (statuses.append(status), finish_task(task, status, result)))
+    try:
+        start_worker(stub.url)
+        start_worker(stub.url)
+        task_id = server.queue_task({"prompt": "room", "n_iter": 1}, "txt2img")["task_id"]
+
+        assert wait_for_tasks([task_id]) == ["success"]
+        assert statuses == ["success"]
+    finally:
+        stub.stop()
@@ -0,0 +1,42 @@
+import pytest
+
+import server
+
+@pytest.fixture
+def client():
+    return server.app.test_client()
+
+@pytest.mark.parametrize("route", ["/generate-first-image", "/generate-next-image"])
+def test_unknown_style_is_rejected(client, route):
+    queued = len(server.task_index)
+    response = client.post(route, json={"prompt": "room", "number_of_images": 1, "style": "Watercolour"})
+
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Unknown style: Watercolour"}
+    assert len(server.task_index) == queued
+
+@pytest.mark.parametrize("route", ["/generate-first-image", "/generate-next-image"])
+def test_missing_prompt_is_still_reported(client, route):
+    response = client.post(route, json={"prompt": " ", "style": "Watercolour"})
+
+    assert response.status_code == 400
+    assert response.get_json() == {"error": "Prompt is required"}
+
+def test_known_and_default_styles_are_applied():
+    style = server.sdxl_styles[server.SDXL_DEFAULT_STYLE]
+    with server.app.test_request_context(json={"prompt": "room", "number_of_images": 2}):
+        prompt, negative_prompt, number_of_images, _, _ = server.validate_first_generation_request({"prompt": "room", "number_of_images": 2})
+    assert prompt == f"{style['prefix']}room{style['suffix']}"
+    assert negative_prompt == style["negative_prompt"]
+    assert number_of_images == 2
+
+    with server.app.test_request_context(json={"prompt": "room", "style": "base"}):
+        prompt, _, _, _, _, _, error_message, _ = server.validate_next_generation_request({"prompt": "room", "style": "base"})
+    assert error_message is None
+    assert prompt == f"{server.sdxl_styles['base']['prefix']}room{server.sdxl_styles['base']['suffix']}"
+
+def test_styles_are_not_checked_without_a_registry(monkeypatch):
+    monkeypatch.setattr(server, "sdxl_styles", {})
+    with server.app.test_request_context(json={"prompt": "room", "style": "Watercolour"}):
+        prompt, negative_prompt, _, _, _ = server.validate_first_generation_request({"prompt": "room", "style": "Watercolour"})
+    assert (prompt, negative_prompt) == ("room", "")
@@ -0,0 +1,58 @@
+from collections import OrderedDict
+import pytest
+
+import server
+from conftest import start_next_task
+
+@pytest.fixture(autouse=True)
+def task_database(task_store, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "TASK_DATABASE_FILE", str(tmp_path / "tasks.db"))
+    monkeypatch.setattr(server, "task_database", server.open_task_database())
+    yield
+    server.task_database.close()
+
+def restart(monkeypatch):
+    """Drop the in-memory task store and the connection, as a crash would, and recover from the database."""
+    server.task_database.close()
+    for name, value in (("task_index", {}), ("task_queue", []), ("running_tasks", {}), ("task_history", OrderedDict()),
+                        ("client_finish_tags", {}), ("next_ticket", 1), ("virtual_time", 0.0), ("task_database", None)):
+        monkeypatch.setattr(server, name, value)
+    server.recover_tasks()
+
+def test_tasks_are_recovered_after_a_restart(monkeypatch):
+    finished_id, running_id, pending_id = [
+        server.queue_task({"prompt": f"room {i}", "n_iter": 1, "init_images": ["A" * 100]}, "img2img", f"client-{i}")["task_id"]
+        for i in range(3)
+    ]
+    server.finish_task(start_next_task(), "success", ["/static/images/room.png"])
+    assert start_next_task()["task_id"] == running_id
+
+    restart(monkeypatch)
+
+    # The task running at the crash is queued again, ahead of the one queued after it
+    assert [schedule_key[2] for schedule_key in server.task_queue] == [running_id, pending_id]
+    running_task = server.get_task_queue_status(running_id)
+    assert (running_task["status"], running_task["position"]) == ("pending", 1)
+    assert server.get_task_queue_status(pending_id)["position"] == 2
+    assert server.task_index[running_id]["_client_id"] == "client-1"
+    assert server.task_index[running_id]["_lane"] == "preview"
+
+    finished_task = server.get_task_queue_status(finished_id)
+    assert (finished_task["status"], finished_task["result"]) == ("success", ["/static/images/room.png"])
+    assert list(server.task_history) == [finished_id]
+    # Finished tasks were compacted before they were persisted
+    assert "init_images" not in finished_task["parameters"]
+
+    # The status column no longer says running, and tickets continue after the recovered ones
+    rows = dict(server.task_database.execute("SELECT task_id, status FROM tasks").fetchall())
+    assert rows == {finished_id: "success", running_id: "pending", pending_id: "pending"}
+    new_id = server.queue_task({"prompt": "room", "n_iter": 1}, "txt2img")["task_id"]
+    assert server.task_index[new_id]["_ticket"] == 4
+
+def test_recovered_tasks_run_in_their_order(monkeypatch):
+    task_ids = [server.queue_task({"prompt": f"room {i}", "n_iter": 1}, "txt2img", "client")["task_id"] for i in range(3)]
+    start_next_task()
+
+    restart(monkeypatch)
+
+    assert [start_next_task()["task_id"] for _ in range(3)] == task_ids
@@ -0,0 +1,53 @@
+import time
+import threading
+import pytest
+
+import server
+
+from conftest import start_next_task
+
+pytestmark = pytest.mark.usefixtures("task_store")
+
+def run_task(prompt):
+    """Queue a task and finish it the way a worker does, returning its task_id."""
+    server.queue_task({"prompt": prompt, "n_iter": 1}, "txt2img")
+    task = start_next_task()
+    server.finish_task(task, "success", [f"/static/images/{prompt}.png"])
+    return task["task_id"]
+
+def test_evicted_tasks_are_read_from_the_archive(monkeypatch):
+    monkeypatch.setattr(server, "TASK_HISTORY_MAX_TASKS", 2)
+    task_ids = [run_task(f"room{i}") for i in range(5)]
+
+    assert list(server.task_history) == task_ids[3:]
+    for i, task_id in enumerate(task_ids):
+        task = server.get_task_queue_status(task_id)
+        assert (task["status"], task["result"]) == ("success", [f"/static/images/room{i}.png"])
+
+    # After a restart the index is rebuilt from the archive file
+    server.archive_index.clear()
+    server.archive_index_file = None
+    assert server.find_archived_task(task_ids[0])["task_id"] == task_ids[0]
+    assert server.find_archived_task("unknown") is None
+
+def test_archive_rotation_keeps_one_previous_file(monkeypatch):
+    monkeypatch.setattr(server, "TASK_HISTORY_MAX_TASKS", 0)
+    monkeypatch.setattr(server, "TASK_ARCHIVE_MAX_BYTES", 1)  # Rotate after every eviction
+    task_ids = [run_task(f"room{i}") for i in range(3)]
+
+    assert server.get_task_queue_status(task_ids[0]) is None
+    assert server.get_task_queue_status(task_ids[1]) is None
+    assert server.get_task_queue_status(task_ids[2])["task_id"] == task_ids[2]
+    assert set(server.archive_index) == {task_ids[2]}
+
+def test_tasks_past_the_ttl_are_evicted_without_a_finish(monkeypatch):
+    task_id = run_task("room")
+    monkeypatch.setattr(server, "TASK_HISTORY_TTL_SECONDS", 0)
+    monkeypatch.setattr(server, "TASK_HISTORY_EVICT_INTERVAL_SECONDS", 0.05)
+    threading.Thread(target=server.task_history_evictor, daemon=True).start()
+
+    deadline = time.monotonic() + 2
+    while task_id in server.task_index and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert task_id not in server.task_index
+    assert server.get_task_queue_status(task_id)["status"] == "success"